@@ -1,9 +1,13 @@
-import os
 import time
+STARTED = time.monotonic()
+import os
+import io
+import json
 import logging
+import functools
+import threading
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from faster_whisper import WhisperModel
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "7188814271:AAE6mUVUXnrMH9bQEdywNJLSrxfUfjZAh90")
 MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
@@ -11,15 +15,17 @@ MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "")
 DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
+OUTPUT_FORMATS = {"SRT": "srt", "VTT": "vtt", "JSON": "json"}
 
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-model = WhisperModel(
-    model_size_or_path="tiny",
-    device="cpu",
-    compute_type="int8"
-)
+model = None
+model_error = None
+model_ready = threading.Event()
+startup_ready_seconds = None
+warmup_queue = []
+warmup_lock = threading.Lock()
 
 LANGS = [
 ("🇬🇧 English","en"), ("🇸🇦 العربية","ar"), ("🇪🇸 Español","es"), ("🇫🇷 Français","fr"),
@@ -37,15 +43,65 @@ LANGS = [
 ]
 
 user_mode = {}
+user_format = {}
 user_selected_lang = {}
 pending_files = {}
 user_transcriptions = {}
 
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
+MODE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
+    [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")]
+])
+FORMAT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Plain text", callback_data="format|Text")],
+    [InlineKeyboardButton("🎬 SRT subtitles", callback_data="format|SRT")],
+    [InlineKeyboardButton("🎞 VTT subtitles", callback_data="format|VTT")],
+    [InlineKeyboardButton("🧾 JSON segments", callback_data="format|JSON")]
+])
+JOIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{REQUIRED_CHANNEL.replace('@', '')}")]])
+
+def load_model():
+    global model, model_error, startup_ready_seconds
+    started = time.monotonic()
+    try:
+        from faster_whisper import WhisperModel
+        model = WhisperModel(
+            model_size_or_path="tiny",
+            device="cpu",
+            compute_type="int8"
+        )
+    except Exception as e:
+        logging.exception("Whisper model failed to load: %s", e)
+        model_error = f"transcription is unavailable ({type(e).__name__})"
+    with warmup_lock:
+        startup_ready_seconds = time.monotonic() - STARTED
+        model_ready.set()
+        queued = warmup_queue[:]
+        del warmup_queue[:]
+    if model_error:
+        logging.info("Failing %d queued file(s) after model load error", len(queued))
+    else:
+        logging.info("Whisper model loaded in %.1fs, %d queued file(s) startup_ready_seconds=%.2f", time.monotonic() - started, len(queued), startup_ready_seconds)
+    for fn, args in queued:
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.exception("Queued transcription failed: %s", e)
+
+def when_ready(fn, *args):
+    with warmup_lock:
+        if not model_ready.is_set():
+            warmup_queue.append((fn, args))
+            return False
+    fn(*args)
+    return True
+
 def get_user_mode(uid):
     return user_mode.get(uid, "📄 Text File")
 
+@functools.lru_cache(maxsize=512)
 def build_lang_keyboard(origin):
     rows = []
     row = []
@@ -67,19 +123,63 @@ def ensure_joined(message):
             return True
     except:
         pass
-    clean = REQUIRED_CHANNEL.replace("@", "")
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{clean}")]])
-    bot.reply_to(message, "First join the channel", reply_markup=kb)
+    bot.reply_to(message, "First join the channel", reply_markup=JOIN_KEYBOARD)
     return False
 
 def whisper_transcribe(path, language):
     segments, _ = model.transcribe(path, language=language)
     text = []
+    timed = []
     for s in segments:
         text.append(s.text)
-    return "".join(text).strip()
+        timed.append({"start": round(s.start, 2), "end": round(s.end, 2), "text": s.text.strip()})
+    return "".join(text).strip(), timed
+
+def transcribe_file(message, path, lang):
+    chat_id = message.chat.id
+    bot.send_chat_action(chat_id, "typing")
+    try:
+        if model_error:
+            raise RuntimeError(model_error)
+        text, segments = whisper_transcribe(path, lang)
+        sent = send_long_text(chat_id, text, message.id, message.from_user.id, segments)
+        if sent:
+            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = {"text": text, "segments": segments}
+    except Exception as e:
+        bot.reply_to(message, f"Error: {e}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def queue_file(message, path, lang):
+    if not when_ready(transcribe_file, message, path, lang):
+        bot.reply_to(message, "⏳ Starting up, your file is queued and will be transcribed in a moment")
+
+def format_timestamp(seconds, sep=","):
+    ms = int(round(max(0.0, seconds) * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    sec, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{sec:02d}{sep}{ms:03d}"
+
+def render_segments(fmt, text, segments):
+    if fmt == "JSON":
+        return json.dumps({"text": text, "segments": segments}, ensure_ascii=False, indent=1)
+    sep = "." if fmt == "VTT" else ","
+    lines = ["WEBVTT", ""] if fmt == "VTT" else []
+    for i, seg in enumerate((seg for seg in segments if seg["text"]), 1):
+        if fmt == "SRT":
+            lines.append(str(i))
+        lines.append(f"{format_timestamp(seg['start'], sep)} --> {format_timestamp(seg['end'], sep)}")
+        lines.append(seg["text"])
+        lines.append("")
+    return "\n".join(lines)
 
-def send_long_text(chat_id, text, reply_id, uid):
+def send_long_text(chat_id, text, reply_id, uid, segments=None):
+    fmt = user_format.get(uid, "Text")
+    if segments and fmt in OUTPUT_FORMATS:
+        doc = render_segments(fmt, text, segments).encode("utf-8")
+        return bot.send_document(chat_id, io.BytesIO(doc), visible_file_name=f"Transcript.{OUTPUT_FORMATS[fmt]}", reply_to_message_id=reply_id)
     mode = get_user_mode(uid)
     if len(text) > MAX_MESSAGE_CHUNK:
         if mode == "Split messages":
@@ -88,12 +188,7 @@ def send_long_text(chat_id, text, reply_id, uid):
                 last = bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
             return last
         else:
-            fname = os.path.join(DOWNLOADS_DIR, "Transcript.txt")
-            with open(fname, "w", encoding="utf-8") as f:
-                f.write(text)
-            sent = bot.send_document(chat_id, open(fname, "rb"), reply_to_message_id=reply_id)
-            os.remove(fname)
-            return sent
+            return bot.send_document(chat_id, io.BytesIO(text.encode("utf-8")), visible_file_name="Transcript.txt", reply_to_message_id=reply_id)
     return bot.send_message(chat_id, text, reply_to_message_id=reply_id)
 
 @bot.message_handler(commands=["start","help"])
@@ -107,11 +202,7 @@ def start_cmd(message):
 def mode_cmd(message):
     if not ensure_joined(message):
         return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
-        [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")]
-    ])
-    bot.reply_to(message, "Choose output mode:", reply_markup=kb)
+    bot.reply_to(message, "Choose output mode:", reply_markup=MODE_KEYBOARD)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("mode|"))
 def mode_cb(call):
@@ -122,6 +213,21 @@ def mode_cb(call):
         pass
     bot.answer_callback_query(call.id, "Mode updated")
 
+@bot.message_handler(commands=["format"])
+def format_cmd(message):
+    if not ensure_joined(message):
+        return
+    bot.reply_to(message, "Choose transcript format:", reply_markup=FORMAT_KEYBOARD)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("format|"))
+def format_cb(call):
+    user_format[call.from_user.id] = call.data.split("|")[1]
+    try:
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    bot.answer_callback_query(call.id, "Format updated")
+
 @bot.callback_query_handler(func=lambda c: c.data.startswith("lang|"))
 def lang_cb(call):
     _, code, lbl, origin = call.data.split("|")
@@ -135,17 +241,7 @@ def lang_cb(call):
     pending = pending_files.pop(chat_id, None)
     if not pending:
         return
-    path = pending["path"]
-    msg = pending["message"]
-    bot.send_chat_action(chat_id, "typing")
-    try:
-        text = whisper_transcribe(path, code)
-        sent = send_long_text(chat_id, text, msg.id, msg.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(chat_id, {})[sent.message_id] = text
-    finally:
-        if os.path.exists(path):
-            os.remove(path)
+    queue_file(pending["message"], pending["path"], code)
 
 @bot.message_handler(content_types=["voice","audio","video","document"])
 def media_handler(message):
@@ -162,21 +258,19 @@ def media_handler(message):
         data = bot.download_file(info.file_path)
         with open(file_path, "wb") as f:
             f.write(data)
-        lang = user_selected_lang.get(message.chat.id)
-        if not lang:
-            pending_files[message.chat.id] = {"path": file_path, "message": message}
-            kb = build_lang_keyboard("file")
-            bot.reply_to(message, "Select language:", reply_markup=kb)
-            return
-        text = whisper_transcribe(file_path, lang)
-        sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = text
     except Exception as e:
         bot.reply_to(message, f"Error: {e}")
-    finally:
         if os.path.exists(file_path):
             os.remove(file_path)
+        return
+    lang = user_selected_lang.get(message.chat.id)
+    if not lang:
+        pending_files[message.chat.id] = {"path": file_path, "message": message}
+        kb = build_lang_keyboard("file")
+        bot.reply_to(message, "Select language:", reply_markup=kb)
+        return
+    queue_file(message, file_path, lang)
 
 if __name__ == "__main__":
+    threading.Thread(target=load_model, name="whisper-warmup", daemon=True).start()
     bot.infinity_polling(timeout=60, long_polling_timeout=60)
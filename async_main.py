@@ -0,0 +1,709 @@
+import os
+import io
+import json
+import asyncio
+import logging
+import shutil
+import time
+import subprocess
+import aiohttp
+import requests
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+import main
+from main import (
+    BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, PORT, CONNECT_TIMEOUT, READ_TIMEOUT, MAX_UPLOAD_SIZE, MAX_UPLOAD_MB,
+    MAX_MESSAGE_CHUNK, REQUIRED_CHANNEL, GEMINI_MODEL, GEMINI_MAX_INPUT_CHARS, GEMINI_PARALLELISM,
+    TRANSCRIBE_BACKEND, VAD_ENABLED, VAD_MIN_SAVED_SECONDS, ADMIN_CHAT_ID, TranscriptCache, KeysExhausted,
+    MEMBER_STATUSES, WEBHOOK_ALLOWED_UPDATES, groq_rotator, gemini_rotator, transcript_cache, gemini_memo,
+    local_backend, membership_cache, metrics,
+)
+
+ASYNC_MAX_JOBS = int(os.environ.get("ASYNC_MAX_JOBS", "2000"))
+ASYNC_IO_CONCURRENCY = int(os.environ.get("ASYNC_IO_CONCURRENCY", "256"))
+ASYNC_HTTP_LIMIT = int(os.environ.get("ASYNC_HTTP_LIMIT", "200"))
+GROQ_URL = main.GROQ_API_URL
+GEMINI_URL = main.GEMINI_API_URL + "/models/{model}:generateContent?key={key}"
+
+if main.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = main.TELEGRAM_API_URL + "/bot{0}/{1}"
+    asyncio_helper.FILE_URL = main.TELEGRAM_API_URL + "/file/bot{0}/{1}"
+bot = AsyncTeleBot(BOT_TOKEN)
+fair_queue = main.FairQueue(main.USER_MAX_CONCURRENT)
+cpu_slots = asyncio.Semaphore(main.CPU_CONCURRENCY)
+io_slots = asyncio.Semaphore(ASYNC_IO_CONCURRENCY)
+gemini_slots = asyncio.Semaphore(GEMINI_PARALLELISM)
+gemini_inflight = {}
+background_tasks = set()
+webhook_task = None
+jobs_running = 0
+_http = None
+
+def get_http():
+    global _http
+    if _http is None or _http.closed:
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        _http = aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT, keepalive_timeout=60))
+    return _http
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def _http_error(status, headers, body):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers)
+    return requests.HTTPError(f"{status} Error: {body[:200]}", response=resp)
+
+async def execute_with_rotation(rotator, action_callback):
+    last_exc = None
+    for _ in range(len(rotator.keys) or 1):
+        key = rotator.get_key()
+        if not key:
+            break
+        start = time.time()
+        key_label = rotator.label(key)
+        try:
+            result = await action_callback(key)
+        except aiohttp.ClientError as e:
+            last_exc = requests.ConnectionError(str(e))
+        except Exception as e:
+            last_exc = e
+        else:
+            elapsed = time.time() - start
+            metrics.inc("api_key_requests_total", api=rotator.name, key=key_label, result="success")
+            metrics.observe("api_key_latency_seconds", elapsed, api=rotator.name, key=key_label)
+            rotator.mark_success(key, elapsed)
+            return result
+        metrics.inc("api_key_requests_total", api=rotator.name, key=key_label, result="failure")
+        metrics.observe("api_key_latency_seconds", time.time() - start, api=rotator.name, key=key_label)
+        logging.warning(f"{rotator.name} error with key {key_label}: {last_exc}")
+        if not rotator.mark_failure(key, last_exc):
+            raise last_exc
+    if not rotator.keys:
+        raise RuntimeError(f"No {rotator.name} keys available")
+    metrics.inc("api_keys_exhausted_total", api=rotator.name)
+    detail = f" Last error: {last_exc}" if last_exc else ""
+    wait = rotator.next_available_in()
+    if wait is None:
+        raise KeysExhausted(f"All {rotator.name} keys are disabled.{detail}")
+    raise KeysExhausted(f"All {rotator.name} keys are cooling down, retry in {wait:.0f}s.{detail}", wait)
+
+async def transcribe_groq(path, language=None, with_segments=False):
+    if not groq_rotator.keys:
+        raise RuntimeError("Groq key(s) not configured")
+    payload = await asyncio.to_thread(lambda: open(path, "rb").read())
+    async def perform(key):
+        form = aiohttp.FormData()
+        form.add_field("model", "whisper-large-v3")
+        if language:
+            form.add_field("language", language)
+        if with_segments:
+            form.add_field("response_format", "verbose_json")
+        form.add_field("file", payload, filename=os.path.basename(path))
+        async with io_slots:
+            async with get_http().post(GROQ_URL, data=form, headers={"authorization": f"Bearer {key}"}) as resp:
+                groq_rotator.observe(key, resp.headers)
+                body = await resp.text()
+                if resp.status >= 400:
+                    raise _http_error(resp.status, resp.headers, body)
+        data = json.loads(body)
+        text = data.get("text") or data.get("transcription") or data.get("transcript") or ""
+        if not text and isinstance(data.get("results"), list) and data["results"]:
+            first = data["results"][0]
+            text = first.get("text") or first.get("transcript") or ""
+        if with_segments:
+            return text, main._groq_segments(data)
+        return text
+    main.groq_backend.last_try = time.time()
+    return await execute_with_rotation(groq_rotator, perform)
+
+async def transcribe_audio(path, language=None, with_segments=False):
+    if TRANSCRIBE_BACKEND == "local":
+        return await asyncio.to_thread(local_backend.transcribe, path, language, with_segments)
+    if TRANSCRIBE_BACKEND == "groq" or not local_backend.available():
+        return await transcribe_groq(path, language, with_segments)
+    if main.groq_backend.healthy():
+        try:
+            return await transcribe_groq(path, language, with_segments)
+        except (KeysExhausted, requests.RequestException) as e:
+            logging.warning("Groq unavailable, falling back to local Whisper: %s", e)
+    return await asyncio.to_thread(local_backend.transcribe, path, language, with_segments)
+
+async def _ask_gemini_once(text, instruction):
+    async def perform(key):
+        payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
+        async with gemini_slots:
+            async with get_http().post(GEMINI_URL.format(model=GEMINI_MODEL, key=key), json=payload) as resp:
+                gemini_rotator.observe(key, resp.headers)
+                body = await resp.text()
+                if resp.status >= 400:
+                    raise _http_error(resp.status, resp.headers, body)
+        try:
+            return json.loads(body)["candidates"][0]["content"]["parts"][0]["text"]
+        except Exception:
+            raise RuntimeError("Unexpected Gemini response")
+    return await execute_with_rotation(gemini_rotator, perform)
+
+async def ask_gemini(text, instruction, merge_instruction=None):
+    if not gemini_rotator.keys:
+        raise RuntimeError("GEMINI_KEY(s) not configured")
+    key = main.gemini_memo_key(text, instruction, merge_instruction)
+    found, value = gemini_memo.lookup(key)
+    if found:
+        return value
+    fut = gemini_inflight.get(key)
+    if fut is not None:
+        gemini_memo.coalesced += 1
+        return await asyncio.shield(fut)
+    fut = gemini_inflight[key] = asyncio.get_running_loop().create_future()
+    gemini_memo.misses += 1
+    try:
+        if len(text) <= GEMINI_MAX_INPUT_CHARS:
+            value = await _ask_gemini_once(text, instruction)
+        else:
+            parts = main.split_text(text, GEMINI_MAX_INPUT_CHARS)
+            results = await asyncio.gather(*(ask_gemini(part, instruction) for part in parts))
+            if merge_instruction:
+                value = await ask_gemini("\n\n".join(results), merge_instruction, merge_instruction)
+            else:
+                value = "\n\n".join(r.strip() for r in results)
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()
+        raise
+    else:
+        gemini_memo.store(key, value)
+        fut.set_result(value)
+        return value
+    finally:
+        gemini_inflight.pop(key, None)
+        if not fut.done():
+            fut.cancel()
+
+async def run_ffmpeg(cmd, stdin_data=None):
+    async with cpu_slots:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, err = await proc.communicate(stdin_data)
+    stderr = err.decode("utf-8", "replace")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr[-2000:])
+    return stderr
+
+async def download_to_file(url, path):
+    size = 0
+    async with io_slots:
+        async with get_http().get(url) as resp:
+            resp.raise_for_status()
+            with open(path, "wb") as f:
+                async for block in resp.content.iter_chunked(65536):
+                    f.write(block)
+                    size += len(block)
+    metrics.inc("media_bytes_total", size)
+
+async def stream_transcode(url, out_path, kbps=None):
+    async with cpu_slots:
+        proc = await asyncio.create_subprocess_exec(*main.ffmpeg_cmd("-y", "-i", "pipe:0", "-vn", "-ar", "16000", "-ac", "1", *(main.profile_args(kbps) if kbps else main.TRANSCODE_CODEC_ARGS), "-f", main.TRANSCODE_FORMAT, out_path), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        err_task = asyncio.ensure_future(proc.stderr.read())
+        size = 0
+        try:
+            async with io_slots:
+                async with get_http().get(url) as resp:
+                    resp.raise_for_status()
+                    async for block in resp.content.iter_chunked(65536):
+                        proc.stdin.write(block)
+                        await proc.stdin.drain()
+                        size += len(block)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception:
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+            stderr = (await err_task).decode("utf-8", "replace")
+            await proc.wait()
+    metrics.inc("media_bytes_total", size)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "ffmpeg", stderr=stderr[-2000:])
+    return main.parse_ffmpeg_time(stderr)
+
+async def plan_audio(path, duration, limit=main.CHUNK_SECONDS):
+    spans = [(0.0, duration)]
+    saved = 0.0
+    if VAD_ENABLED and duration > VAD_MIN_SAVED_SECONDS:
+        try:
+            stderr = await run_ffmpeg(main.silencedetect_cmd(path))
+            spans, saved = main.choose_spans(main.parse_speech_spans(stderr, duration), duration)
+        except subprocess.CalledProcessError:
+            pass
+    return main.plan_speech_chunks(spans, limit), saved
+
+async def check_membership(user_id):
+    cached = membership_cache.lookup(user_id)
+    if cached is not None:
+        return cached
+    try:
+        is_member = (await bot.get_chat_member(REQUIRED_CHANNEL, user_id)).status in MEMBER_STATUSES
+    except Exception as e:
+        stale = membership_cache.stale(user_id)
+        logging.warning("Membership check failed for %s, using %s: %s", user_id, "stale result" if stale is not None else "fail-open", e)
+        return True if stale is None else stale
+    membership_cache.put(user_id, is_member)
+    return is_member
+
+async def ensure_joined(message, user=None):
+    if not REQUIRED_CHANNEL:
+        return True
+    if await check_membership((user or message.from_user).id):
+        return True
+    if user is not None:
+        await bot.send_message(message.chat.id, "First, join my channel and come back 👍", reply_markup=main.JOIN_KEYBOARD)
+    else:
+        await bot.reply_to(message, "First, join my channel and come back 👍", reply_markup=main.JOIN_KEYBOARD)
+    return False
+
+async def send_segments(chat_id, text, segments, reply_id, uid, action="Transcript"):
+    if not segments:
+        return None
+    fmt = await asyncio.to_thread(main.get_user_format, uid)
+    if fmt not in main.OUTPUT_FORMATS:
+        return None
+    doc = io.BytesIO(main.render_segments(fmt, text, segments).encode("utf-8"))
+    doc.name = f"{action}.{main.OUTPUT_FORMATS[fmt]}"
+    return await bot.send_document(chat_id, doc, caption=f"{fmt} with timestamps 🕒", reply_to_message_id=reply_id)
+
+async def send_long_text(chat_id, text, reply_id, uid, action="Transcript", segments=None):
+    sent = await send_segments(chat_id, text, segments, reply_id, uid, action)
+    if sent:
+        return sent
+    mode = await asyncio.to_thread(main.get_user_mode, uid)
+    if len(text) > MAX_MESSAGE_CHUNK:
+        if mode in ("Split messages", "Live"):
+            sent = None
+            for i in range(0, len(text), MAX_MESSAGE_CHUNK):
+                sent = await bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
+            return sent
+        doc = io.BytesIO(text.encode("utf-8"))
+        doc.name = f"{action}.txt"
+        return await bot.send_document(chat_id, doc, caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
+    return await bot.send_message(chat_id, text, reply_to_message_id=reply_id)
+
+async def deliver_transcript(message, status_msg, final_text, segments=None):
+    if status_msg:
+        try:
+            await bot.delete_message(message.chat.id, status_msg.message_id)
+        except:
+            pass
+    sent = await send_long_text(message.chat.id, final_text, message.id, message.from_user.id, segments=segments)
+    if sent:
+        await asyncio.to_thread(main.save_transcription, message.chat.id, sent.message_id, main.transcript_record(message, final_text, segments))
+        try:
+            await bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=main.build_action_keyboard(len(final_text)))
+        except:
+            pass
+    return sent
+
+@bot.chat_member_handler()
+async def chat_member_update(update):
+    if main.is_required_channel(update.chat):
+        membership_cache.put(update.new_chat_member.user.id, update.new_chat_member.status in MEMBER_STATUSES, from_update=True)
+
+@bot.message_handler(commands=['start', 'help'])
+async def send_welcome(message):
+    if await ensure_joined(message):
+        await bot.reply_to(message, main.WELCOME_TEXT, reply_markup=main.build_lang_keyboard("file"), parse_mode="Markdown")
+
+@bot.message_handler(commands=['mode'])
+async def choose_mode(message):
+    if await ensure_joined(message):
+        await bot.reply_to(message, "How do I send you long transcripts?:", reply_markup=main.MODE_KEYBOARD)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('mode|'))
+async def mode_cb(call):
+    if not await ensure_joined(call.message, call.from_user):
+        return
+    mode = call.data.split("|")[1]
+    await asyncio.to_thread(main.state.set, "mode", call.from_user.id, mode, main.PREFS_TTL)
+    try:
+        await bot.edit_message_text(f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    await bot.answer_callback_query(call.id, f"Mode set to: {mode} ☑️")
+
+@bot.message_handler(commands=['format'])
+async def choose_format(message):
+    if await ensure_joined(message):
+        await bot.reply_to(message, "Which format do you want your transcripts in?", reply_markup=main.FORMAT_KEYBOARD)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('format|'))
+async def format_cb(call):
+    if not await ensure_joined(call.message, call.from_user):
+        return
+    fmt = call.data.split("|")[1]
+    await asyncio.to_thread(main.state.set, "format", call.from_user.id, fmt, main.PREFS_TTL)
+    try:
+        await bot.edit_message_text(f"you choosed: {fmt}", call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    await bot.answer_callback_query(call.id, f"Format set to: {fmt} ☑️")
+
+@bot.message_handler(commands=['lang'])
+async def lang_command(message):
+    if await ensure_joined(message):
+        await bot.reply_to(message, "Select the language spoken in your audio or video:", reply_markup=main.build_lang_keyboard("file"))
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('lang|'))
+async def lang_cb(call):
+    _, code, lbl, origin = call.data.split("|")
+    if origin != "file":
+        try:
+            await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        except:
+            pass
+        await process_text_action(call, origin, f"Translate to {lbl}", f"Translate this text in to language {lbl}. No extra text ONLY return the translated text.")
+        return
+    try:
+        await bot.delete_message(call.message.chat.id, call.message.message_id)
+    except:
+        try:
+            await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        except:
+            pass
+    await asyncio.to_thread(main.state.set, "lang", call.message.chat.id, code, main.PREFS_TTL)
+    await bot.answer_callback_query(call.id, f"Language set: {lbl} ☑️")
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('summarize_menu|'))
+async def action_cb(call):
+    try:
+        await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=main.build_summarize_keyboard(call.message.id))
+    except:
+        try:
+            await bot.answer_callback_query(call.id, "Opening summarize options...")
+        except:
+            pass
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('summopt|'))
+async def summopt_cb(call):
+    try:
+        _, style, origin = call.data.split("|")
+    except:
+        await bot.answer_callback_query(call.id, "Invalid option", show_alert=True)
+        return
+    try:
+        await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    await process_text_action(call, origin, f"Summarize ({style})", main.summary_prompt(style), main.summary_merge_prompt(style), timed=True)
+
+async def process_text_action(call, origin_msg_id, log_action, prompt_instr, merge_instr=None, timed=False):
+    chat_id = call.message.chat.id
+    try:
+        origin_id = int(origin_msg_id)
+    except:
+        origin_id = call.message.message_id
+    data = await asyncio.to_thread(main.get_transcription, chat_id, origin_id)
+    if not data and call.message.reply_to_message:
+        data = await asyncio.to_thread(main.get_transcription, chat_id, call.message.reply_to_message.message_id)
+    if not data:
+        await bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
+        return
+    text = data["text"]
+    if timed and data.get("segments"):
+        text = main.timestamped_text(data["segments"])
+        prompt_instr = f"{prompt_instr} {main.TIMESTAMP_HINT}"
+        merge_instr = merge_instr and f"{merge_instr} {main.TIMESTAMP_HINT}"
+    await bot.answer_callback_query(call.id, "Processing...")
+    await bot.send_chat_action(chat_id, 'typing')
+    try:
+        res = await ask_gemini(text, prompt_instr, merge_instr)
+        await send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
+    except Exception as e:
+        await bot.send_message(chat_id, f"Error: {e}")
+
+@bot.message_handler(content_types=['voice', 'audio', 'video', 'document'])
+async def handle_media(message):
+    if not await ensure_joined(message):
+        return
+    media = message.voice or message.audio or message.video or message.document
+    if not media:
+        return
+    try:
+        await bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
+    except:
+        pass
+    if getattr(media, 'file_size', 0) > MAX_UPLOAD_SIZE:
+        await bot.reply_to(message, f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎")
+        return
+    lang = await asyncio.to_thread(main.get_user_lang, message.chat.id)
+    uid = message.from_user.id
+    fmt = await asyncio.to_thread(main.get_user_format, uid)
+    cached = await asyncio.to_thread(lambda: transcript_cache.get(TranscriptCache.make_key("fid", getattr(media, "file_unique_id", None), lang), with_segments=True))
+    if cached and (cached[1] or fmt not in main.OUTPUT_FORMATS):
+        await deliver_transcript(message, None, *cached)
+        return
+    if fair_queue.pending(uid) >= main.USER_MAX_QUEUED:
+        await bot.reply_to(message, f"You already have {main.USER_MAX_QUEUED} files waiting, let them finish first 🙏")
+        return
+    if not main.media_limiter.allow(uid):
+        metrics.inc("media_rate_limited_total")
+        await bot.reply_to(message, "You're sending files too fast, please wait a minute 🙏")
+        return
+    reservation = main.scratch.reserve(main.estimate_scratch(media))
+    if reservation is None:
+        metrics.inc("media_rejected_total", reason="disk")
+        await bot.reply_to(message, "I'm short on disk space right now, please send it again in a few minutes 🙏")
+        return
+    try:
+        status_msg = await bot.reply_to(message, "Downloading your file...")
+    except Exception:
+        main.scratch.release(reservation)
+        raise
+    cost = main.estimate_cost(media)
+    position = fair_queue.position(uid, cost) - (ASYNC_MAX_JOBS - jobs_running) + 1
+    if position > 0:
+        try:
+            await bot.edit_message_text(f"You are #{position} in queue ⏳", message.chat.id, status_msg.message_id)
+        except:
+            pass
+    ticket = asyncio.get_running_loop().create_future()
+    fair_queue.push(uid, cost, (ticket, time.monotonic()))
+    dispatch_jobs()
+    spawn(run_media_job(message, media, status_msg, lang, ticket, reservation))
+
+def dispatch_jobs():
+    global jobs_running
+    while jobs_running < ASYNC_MAX_JOBS:
+        job = fair_queue.pop()
+        if job is None:
+            return
+        ticket, queued_at = job[2]
+        jobs_running += 1
+        metrics.observe("media_queue_wait_seconds", time.monotonic() - queued_at, lane="async")
+        ticket.set_result(job[0])
+
+async def run_media_job(message, media, status_msg, lang, ticket, reservation=None):
+    global jobs_running
+    user = await ticket
+    try:
+        await process_media(message, media, status_msg, lang, reservation)
+    finally:
+        jobs_running -= 1
+        fair_queue.done(user)
+        dispatch_jobs()
+
+async def process_media(message, media, status_msg, lang, reservation=None):
+    trace = main.JobTrace("media_async", chat_id=message.chat.id, message_id=message.id, file_size=getattr(media, "file_size", 0))
+    workdir = main.scratch.open(reservation)
+    try:
+        with trace.stage("get_file"):
+            file_info = await bot.get_file(media.file_id)
+        download_url = main.telegram_file_url(file_info.file_path)
+        local_path = main.local_file_path(file_info.file_path)
+        file_size = getattr(media, "file_size", 0) or 0
+        audio = os.path.join(workdir, "audio" + main.TRANSCODE_EXT)
+        duration = 0.0
+        streamed = False
+        if main.STREAM_TRANSCODE and not local_path and file_size < main.RANGE_MIN_BYTES and main.can_stream(media, file_info.file_path) and not main.prefer_probe(media, file_info.file_path):
+            kbps = main.encode_profile(float(getattr(media, "duration", 0) or 0))
+            try:
+                with trace.stage("download_transcode"):
+                    duration = await stream_transcode(download_url, audio, kbps)
+                streamed = True
+                trace.fields["transcode"] = "stream"
+                trace.fields["kbps"] = kbps
+                metrics.inc("media_encode_profile_total", kbps=kbps)
+                metrics.inc("media_transcode_total", mode="stream")
+            except subprocess.CalledProcessError as e:
+                logging.info("Pipe transcode failed (%s), falling back to temp file", (e.stderr or "").strip()[-200:])
+        if not streamed:
+            src = local_path or os.path.join(workdir, "input")
+            if not local_path:
+                with trace.stage("download"):
+                    if file_size >= main.RANGE_MIN_BYTES:
+                        async with io_slots:
+                            await asyncio.to_thread(main.fetch_file, download_url, src, file_size, None, getattr(media, "file_unique_id", None))
+                    else:
+                        await download_to_file(download_url, src)
+            with trace.stage("probe"):
+                info = await asyncio.to_thread(main.probe_media, src)
+            mode, ext = main.choose_transcode(info)
+            trace.fields["transcode"] = mode
+            metrics.inc("media_transcode_total", mode=mode)
+            audio = os.path.join(workdir, "audio" + ext)
+            if mode == "skip":
+                if local_path:
+                    await asyncio.to_thread(shutil.copyfile, local_path, audio)
+                else:
+                    os.replace(src, audio)
+                duration = info["duration"]
+            else:
+                kbps = main.encode_profile((info or {}).get("duration") or float(getattr(media, "duration", 0) or 0)) if mode == "encode" else None
+                if kbps:
+                    trace.fields["kbps"] = kbps
+                    metrics.inc("media_encode_profile_total", kbps=kbps)
+                with trace.stage("transcode"):
+                    stderr = await run_ffmpeg(main.transcode_cmd(src, audio, mode, kbps))
+                duration = main.parse_ffmpeg_time(stderr)
+                if not local_path:
+                    os.remove(src)
+        duration = duration or float(getattr(media, "duration", 0) or 0)
+        trace.fields["audio_seconds"] = round(duration, 2)
+        metrics.inc("media_audio_seconds_total", duration)
+        try:
+            await bot.edit_message_text("Processing...", message.chat.id, status_msg.message_id)
+        except:
+            pass
+        digest = await asyncio.to_thread(main.audio_sha256, audio)
+        cache_keys = [TranscriptCache.make_key("fid", getattr(media, "file_unique_id", None), lang), TranscriptCache.make_key("sha256", digest, lang)]
+        cached = await asyncio.to_thread(lambda: transcript_cache.get(cache_keys[1], with_segments=True))
+        fmt = await asyncio.to_thread(main.get_user_format, message.from_user.id)
+        if cached and (cached[1] or fmt not in main.OUTPUT_FORMATS):
+            await asyncio.to_thread(transcript_cache.put, cache_keys[:1], *cached)
+            with trace.stage("send"):
+                await deliver_transcript(message, status_msg, *cached)
+            trace.finish("cached")
+            return
+        limit = main.chunk_limit(os.path.getsize(audio), duration)
+        with trace.stage("segment"):
+            chunks, saved = await plan_audio(audio, duration, limit)
+        trace.fields["chunks"] = len(chunks)
+        trace.fields["vad_saved"] = round(saved, 2)
+        if len(chunks) == 1 and chunks[0]["spans"] == [(0.0, duration)]:
+            with trace.stage("transcribe"):
+                final_text, segments = await transcribe_audio(audio, lang, True)
+        else:
+            chunk_files = [os.path.join(workdir, f"chunk_{i:03d}{main.chunk_suffix(audio, chunk)}") for i, chunk in enumerate(chunks)]
+            with trace.stage("segment"):
+                codec_args = main.profile_args(main.encode_profile(limit))
+                await asyncio.gather(*(run_ffmpeg(main.render_chunk_cmd(audio, chunk, cf, codec_args)) for chunk, cf in zip(chunks, chunk_files)))
+            transcribe_slots = asyncio.Semaphore(main.TRANSCRIBE_PARALLELISM)
+            async def run(cf):
+                async with transcribe_slots:
+                    with metrics.timer("media_stage_seconds", stage="transcribe_chunk"):
+                        return await transcribe_audio(cf, lang, True)
+            with trace.stage("transcribe"):
+                results = await asyncio.gather(*(run(cf) for cf in chunk_files))
+            final_text = main.merge_overlapping_texts([text for text, _ in results], [c["overlap"] for c in chunks])
+            segments = main.merge_segments([segs for _, segs in results], chunks)
+        if not final_text:
+            raise ValueError("Empty transcription")
+        trace.fields["segments"] = len(segments or [])
+        await asyncio.to_thread(transcript_cache.put, cache_keys, final_text, segments)
+        with trace.stage("send"):
+            await deliver_transcript(message, status_msg, final_text, segments)
+        trace.finish("ok", chars=len(final_text))
+    except Exception as e:
+        logging.exception("Media job failed for chat %s: %s", message.chat.id, e)
+        trace.finish("error", error=f"{type(e).__name__}: {e}")
+        await bot.send_message(message.chat.id, "😓")
+    finally:
+        await asyncio.to_thread(main.scratch.close, workdir)
+
+async def _respond(send, status, body=b"", content_type=b"text/plain; charset=utf-8"):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+async def register_webhook():
+    delay = 1.0
+    while True:
+        try:
+            if main.webhook_matches(await bot.get_webhook_info()):
+                logging.info("Webhook already registered at %s", WEBHOOK_URL)
+                metrics.inc("startup_webhook_total", action="kept")
+            else:
+                await bot.set_webhook(url=WEBHOOK_URL, allowed_updates=WEBHOOK_ALLOWED_UPDATES)
+                metrics.inc("startup_webhook_total", action="set")
+            break
+        except Exception as e:
+            logging.exception("Webhook registration failed, retrying in %.0fs: %s", delay, e)
+            metrics.inc("startup_webhook_total", action="error")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+    metrics.set("startup_ready_seconds", time.monotonic() - main.PROCESS_STARTED, component="webhook")
+    logging.info("Ready %.2fs after process start", time.monotonic() - main.PROCESS_STARTED)
+
+async def startup():
+    global webhook_task
+    main.scratch.start_sweeper(main.SCRATCH_SWEEP_INTERVAL)
+    if TRANSCRIBE_BACKEND != "groq" and local_backend.available():
+        asyncio.get_running_loop().run_in_executor(None, local_backend.warm)
+    if WEBHOOK_URL:
+        webhook_task = spawn(register_webhook())
+
+async def shutdown():
+    if webhook_task is not None:
+        webhook_task.cancel()
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    if _http is not None:
+        await _http.close()
+    try:
+        await bot.close_session()
+    except AttributeError:
+        pass
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+    if method == "GET" and path == "/":
+        await _respond(send, 200, b"Bot Running")
+    elif method == "GET" and path == "/metrics":
+        metrics.set("async_background_tasks", len(background_tasks))
+        metrics.set("async_jobs_waiting", fair_queue.size)
+        metrics.set("async_jobs_running", jobs_running)
+        await _respond(send, 200, metrics.render().encode(), b"text/plain; version=0.0.4")
+    elif method == "POST" and path == WEBHOOK_PATH:
+        headers = dict(scope.get("headers") or [])
+        if not headers.get(b"content-type", b"").startswith(b"application/json"):
+            await _respond(send, 403)
+            return
+        body = await _read_body(receive)
+        try:
+            update = Update.de_json(body.decode("utf-8"))
+            if not main.recent_updates.add(update.update_id):
+                metrics.inc("webhook_duplicates_total")
+                await _respond(send, 200)
+                return
+            spawn(bot.process_new_updates([update]))
+        except Exception as e:
+            logging.exception("Error processing update: %s", e)
+        await _respond(send, 200)
+    else:
+        await _respond(send, 404)
+
+if __name__ == "__main__":
+    if not WEBHOOK_URL:
+        print("Webhook URL not set, exiting.")
+    else:
+        try:
+            import uvicorn
+        except ImportError:
+            raise SystemExit("The async runtime needs an ASGI server: pip install uvicorn")
+        uvicorn.run(asgi_app, host="0.0.0.0", port=PORT, lifespan="on")
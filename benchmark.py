@@ -0,0 +1,529 @@
+import os
+import sys
+import json
+import math
+import time
+import wave
+import random
+import shutil
+import struct
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BENCH_TOKEN = "123456:BENCH"
+TRANSCRIPT_MARK = "bench transcript"
+SUMMARY_MARK = "bench summary"
+FIXTURE_KINDS = ("voice", "audio", "video", "document")
+
+class StubServer:
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.httpd = None
+    def start(self, route):
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def _handle(self):
+                length = int(self.headers.get("content-length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with stub.lock:
+                    roll = stub.random.random()
+                    delay = max(0.0, stub.latency + stub.random.uniform(-stub.jitter, stub.jitter))
+                    stub.counts["requests"] += 1
+                if delay:
+                    time.sleep(delay)
+                if roll < stub.rate_limit_rate:
+                    stub.count("429")
+                    return self.reply(429, {"error": {"message": "rate limited"}}, {"Retry-After": "1"})
+                if roll < stub.rate_limit_rate + stub.error_rate:
+                    stub.count("5xx")
+                    return self.reply(503, {"error": {"message": "injected failure"}})
+                route(self, body)
+            def reply(self, status, payload, headers=None, raw=None, content_type="application/json"):
+                data = raw if raw is not None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+            do_GET = _handle
+            do_POST = _handle
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name=f"stub-{self.name}", daemon=True).start()
+        return self
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.sent = {}
+        self.kinds = {}
+        self.done = {}
+        self.errors = collections.Counter()
+    def expect(self, chat_id, kind):
+        with self.lock:
+            self.sent[chat_id] = time.monotonic()
+            self.kinds[chat_id] = kind
+    def complete(self, chat_id, status):
+        with self.cond:
+            if chat_id in self.sent and chat_id not in self.done:
+                self.done[chat_id] = (time.monotonic() - self.sent[chat_id], status)
+                self.cond.notify_all()
+    def wait(self, total, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.done) < total:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+        return True
+
+def telegram_route(fixtures, recorder, stub):
+    counter = [1000]
+    lock = threading.Lock()
+    def next_id():
+        with lock:
+            counter[0] += 1
+            return counter[0]
+    def route(handler, body):
+        parsed = urlparse(handler.path)
+        parts = parsed.path.strip("/").split("/")
+        if parts[0] == "file":
+            return serve_file(handler, fixtures, parts[-1])
+        method = parts[-1]
+        stub.count(method)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if handler.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8", "replace")).items()})
+        chat_id = int(params.get("chat_id", 0) or 0)
+        text = params.get("text", "")
+        if method == "getFile":
+            name = params.get("file_id", "").split("#")[0]
+            path = fixtures.get(name, "")
+            result = {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"), "file_size": os.path.getsize(path) if path else 0, "file_path": f"fixtures/{name}"}
+        elif method in ("sendMessage", "sendDocument", "editMessageText", "forwardMessage", "copyMessage"):
+            if method == "sendDocument" or (method == "sendMessage" and (TRANSCRIPT_MARK in text or SUMMARY_MARK in text)):
+                recorder.complete(chat_id, "ok")
+            elif method == "sendMessage" and text.startswith(("😓", "Error:")):
+                recorder.complete(chat_id, "error")
+                stub.count("error_replies")
+                if text.startswith("Error:"):
+                    recorder.errors[text[:120]] += 1
+            result = {"message_id": next_id(), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": text}
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id", 0) or 0), "is_bot": False, "first_name": "Bench"}}
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        handler.reply(200, {"ok": True, "result": result})
+    return route
+
+def serve_file(handler, fixtures, name):
+    path = fixtures.get(name)
+    if not path:
+        return handler.reply(404, {"ok": False})
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    rng = handler.headers.get("Range")
+    if rng and rng.startswith("bytes="):
+        a, _, b = rng[6:].partition("-")
+        start, end = int(a or 0), min(size - 1, int(b) if b else size - 1)
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start + 1)
+    handler.reply(status, None, headers, raw=data, content_type="application/octet-stream")
+
+def groq_route(transcript_chars, per_mb):
+    filler = (" lorem ipsum dolor sit amet" * (transcript_chars // 27 + 1))[:transcript_chars]
+    def route(handler, body):
+        if per_mb:
+            time.sleep(per_mb * len(body) / (1024 * 1024))
+        text = TRANSCRIPT_MARK + filler
+        handler.reply(200, {"text": text, "segments": [{"start": 0.0, "end": 5.0, "text": text}]})
+    return route
+
+def gemini_route():
+    def route(handler, body):
+        handler.reply(200, {"candidates": [{"content": {"parts": [{"text": f"{SUMMARY_MARK}: {len(body)} bytes in"}]}}]})
+    return route
+
+def write_wav(path, seconds, rate=16000):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        frames = bytearray()
+        for i in range(int(seconds * rate)):
+            speaking = (i // rate) % 4 != 3
+            frames += struct.pack("<h", int(8000 * math.sin(2 * math.pi * 220 * i / rate)) if speaking else 0)
+        w.writeframes(bytes(frames))
+
+def generate_fixtures(directory, seconds):
+    os.makedirs(directory, exist_ok=True)
+    gate = "volume='if(lt(mod(t,4),3),1,0)':eval=frame"
+    specs = {
+        "voice": ("voice.ogg", ["-f", "lavfi", "-i", f"sine=frequency=220:duration={seconds}", "-af", gate, "-ac", "1", "-c:a", "libopus", "-b:a", "24k"]),
+        "audio": ("audio.mp3", ["-f", "lavfi", "-i", f"sine=frequency=330:duration={seconds * 3}", "-af", gate, "-ac", "2", "-ar", "44100", "-b:a", "128k"]),
+        "video": ("video.mp4", ["-f", "lavfi", "-i", f"testsrc=size=320x240:rate=10:duration={seconds * 2}", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds * 2}", "-c:v", "mpeg4", "-c:a", "aac", "-b:a", "96k", "-shortest"]),
+        "document": ("document.wav", ["-f", "lavfi", "-i", f"sine=frequency=550:duration={seconds}", "-af", gate, "-ac", "1", "-ar", "16000"]),
+    }
+    fixtures = {}
+    have_ffmpeg = shutil.which("ffmpeg") is not None
+    if not have_ffmpeg:
+        print("warning: ffmpeg not found, writing WAV fixtures only; the media pipeline needs ffmpeg to succeed", file=sys.stderr)
+    for kind, (name, args) in specs.items():
+        path = os.path.join(directory, name)
+        if not have_ffmpeg:
+            name = kind + ".wav"
+            path = os.path.join(directory, name)
+            write_wav(path, seconds)
+        elif not os.path.exists(path):
+            subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", *args, path], check=True)
+        fixtures[kind] = name
+        fixtures[name] = path
+    return fixtures
+
+def build_updates(fixtures, count, mix, users, seconds, seed):
+    rng = random.Random(seed)
+    kinds = [k for k, w in mix.items() for _ in range(w)]
+    updates = []
+    for i in range(count):
+        kind = rng.choice(kinds)
+        chat_id = 10_000_000 + i
+        user = {"id": 1000 + i % users, "is_bot": False, "first_name": "Bench"}
+        base = {"message_id": i + 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": user}
+        if kind == "callback":
+            message = dict(base, message_id=500_000 + i, **{"from": {"id": 123456, "is_bot": True, "first_name": "Bench"}}, text="transcript")
+            updates.append((chat_id, kind, {"update_id": i + 1, "callback_query": {"id": str(i), "from": user, "chat_instance": "bench", "data": f"summopt|Short|{500_000 + i}", "message": message}}))
+            continue
+        name = fixtures[kind]
+        size = os.path.getsize(fixtures[name])
+        length = seconds * {"audio": 3, "video": 2}.get(kind, 1)
+        media = {"file_id": f"{name}#{i}", "file_unique_id": f"bench{i}", "file_size": size}
+        if kind == "voice":
+            media.update(duration=length, mime_type="audio/ogg")
+        elif kind == "audio":
+            media.update(duration=length, mime_type="audio/mpeg", title="bench")
+        elif kind == "video":
+            media.update(duration=length, mime_type="video/mp4", width=320, height=240)
+        else:
+            media.update(mime_type="audio/wav", file_name=name)
+        updates.append((chat_id, kind, {"update_id": i + 1, "message": dict(base, **{kind: media})}))
+    return updates
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))]
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def current_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Sampler:
+    def __init__(self, scratch, interval=0.2):
+        self.scratch = scratch
+        self.interval = interval
+        self.peak = {"rss": 0, "threads": 0, "disk": 0}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak["rss"] = max(self.peak["rss"], current_rss())
+            self.peak["threads"] = max(self.peak["threads"], threading.active_count())
+            self.peak["disk"] = max(self.peak["disk"], dir_size(self.scratch))
+            self.stopped.wait(self.interval)
+    def start(self):
+        self.thread.start()
+        return self
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak["rss"] = max(self.peak["rss"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        self.peak["children_rss"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        return self.peak
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in FIXTURE_KINDS + ("callback",):
+            raise SystemExit(f"unknown update kind: {kind}")
+        mix[kind.strip()] = int(weight or 1)
+    return mix
+
+def configure_env(args, workdir, telegram, groq, gemini):
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_API_URL": telegram.url,
+        "GROQ_API_URL": groq.url + "/openai/v1/audio/transcriptions",
+        "GEMINI_API_URL": gemini.url + "/v1beta",
+        "GROQ_KEYS": ",".join(f"bench-groq-{i}" for i in range(args.groq_keys)),
+        "GEMINI_KEYS": "bench-gemini",
+        "DOWNLOADS_DIR": workdir,
+        "TRANSCRIBE_BACKEND": "groq",
+        "REQUIRED_CHANNEL": "",
+        "STATE_BACKEND": "memory",
+        "HTTP_POOL_SIZES": "127.0.0.1=64",
+        "TRANSCRIPT_CACHE_PATH": "",
+        "TRANSCRIPT_CACHE_TTL": str(7 * 24 * 3600 if args.cache else 0),
+    })
+
+def run(args):
+    scratch = tempfile.mkdtemp(prefix="bench_")
+    fixtures = generate_fixtures(args.fixtures or os.path.join(scratch, "fixtures"), args.seconds)
+    workdir = os.path.join(scratch, "work")
+    os.makedirs(workdir)
+    recorder = Recorder()
+    telegram = StubServer("telegram", args.telegram_latency, args.jitter, args.telegram_error_rate, 0.0, args.seed)
+    telegram.start(telegram_route(fixtures, recorder, telegram))
+    groq = StubServer("groq", args.groq_latency, args.jitter, args.groq_error_rate, args.groq_429_rate, args.seed + 1).start(groq_route(args.transcript_chars, args.groq_per_mb))
+    gemini = StubServer("gemini", args.gemini_latency, args.jitter, args.gemini_error_rate, args.gemini_429_rate, args.seed + 2).start(gemini_route())
+    configure_env(args, workdir, telegram, groq, gemini)
+    import logging
+    import requests
+    import main
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    from werkzeug.serving import make_server
+    updates = build_updates(fixtures, args.updates, parse_mix(args.mix), args.users, args.seconds, args.seed)
+    for chat_id, kind, update in updates:
+        if kind == "callback":
+            msg = update["callback_query"]["message"]
+            main.save_transcription(chat_id, msg["message_id"], {"text": f"transcript {chat_id} " + "words " * 200, "origin": msg["message_id"]})
+    server = make_server("127.0.0.1", 0, main.flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-webhook", daemon=True).start()
+    webhook = f"http://127.0.0.1:{server.server_port}{main.WEBHOOK_PATH}"
+    client = requests.Session()
+    sampler = Sampler(workdir).start()
+    threads_before = threading.active_count()
+    started = time.monotonic()
+    for i, (chat_id, kind, update) in enumerate(updates):
+        if args.rate:
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        recorder.expect(chat_id, kind)
+        client.post(webhook, data=json.dumps(update), headers={"Content-Type": "application/json"}, timeout=30)
+    finished = recorder.wait(len(updates), args.timeout)
+    wall = time.monotonic() - started
+    peak = sampler.stop()
+    server.shutdown()
+    for stub in (telegram, groq, gemini):
+        stub.stop()
+    report = summarize(recorder, updates, wall, peak, threads_before, {"telegram": telegram, "groq": groq, "gemini": gemini}, main)
+    report["complete"] = finished
+    report["ffmpeg"] = shutil.which("ffmpeg") is not None
+    report["passed"] = finished and report["ffmpeg"] and not report["statuses"].get("error")
+    if not args.keep:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return report
+
+def parse_profiles(text):
+    profiles = []
+    for item in text.split(","):
+        target, _, kbps = item.strip().partition(":")
+        profiles.append((target, int(kbps)))
+    return profiles
+
+def child_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_profiles(args):
+    if shutil.which("ffmpeg") is None:
+        raise SystemExit("the profile benchmark needs ffmpeg")
+    scratch = tempfile.mkdtemp(prefix="bench_profiles_")
+    telegram = StubServer("telegram").start(lambda handler, body: handler.reply(200, {"ok": True, "result": True}))
+    groq = StubServer("groq", args.groq_latency, args.jitter, 0.0, 0.0, args.seed + 1).start(groq_route(args.transcript_chars, args.groq_per_mb))
+    gemini = StubServer("gemini").start(gemini_route())
+    configure_env(args, scratch, telegram, groq, gemini)
+    import main
+    source = os.path.join(scratch, "source.mp3")
+    gate = "volume='if(lt(mod(t,4),3),1,0)':eval=frame"
+    subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=330:duration={args.profile_seconds}", "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.05:duration={args.profile_seconds}", "-filter_complex", f"[0:a]{gate}[s];[s][1:a]amix=inputs=2", "-ac", "2", "-ar", "44100", "-b:a", "128k", source], check=True)
+    source_bytes = os.path.getsize(source)
+    rows = []
+    for target, kbps in parse_profiles(args.profiles):
+        ext = main.TRANSCODE_TARGETS[target][0]
+        out = os.path.join(scratch, f"{target}{kbps}{ext}")
+        cpu = child_cpu()
+        started = time.monotonic()
+        subprocess.run(main.ffmpeg_cmd("-y", "-loglevel", "error", "-i", source, "-vn", "-ar", "16000", "-ac", "1", *main.profile_args(kbps, target), out), check=True)
+        encode_wall = time.monotonic() - started
+        encode_cpu = child_cpu() - cpu
+        size = os.path.getsize(out)
+        duration = main.get_audio_duration(out) or float(args.profile_seconds)
+        chunks = main.plan_speech_chunks([(0.0, duration)], main.chunk_limit(size, duration))
+        chunk_files = []
+        for i, chunk in enumerate(chunks):
+            cf = os.path.join(scratch, f"{target}{kbps}_{i:03d}{main.chunk_suffix(out, chunk)}")
+            main.render_chunk(out, chunk, cf)
+            chunk_files.append(cf)
+        before = groq.counts["requests"]
+        started = time.monotonic()
+        main.transcribe_chunks(chunk_files, overlaps=[c["overlap"] for c in chunks])
+        rows.append({
+            "profile": f"{target}:{kbps}",
+            "bytes": size,
+            "upload_bytes": sum(os.path.getsize(cf) for cf in chunk_files),
+            "ratio": size / source_bytes,
+            "requests": groq.counts["requests"] - before,
+            "encode_cpu_seconds": encode_cpu,
+            "encode_wall_seconds": encode_wall,
+            "transcribe_seconds": time.monotonic() - started,
+        })
+    for stub in (telegram, groq, gemini):
+        stub.stop()
+    if not args.keep:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {"seconds": args.profile_seconds, "source_bytes": source_bytes, "budget_bytes": main.UPLOAD_BUDGET_BYTES, "profiles": rows, "complete": True}
+
+def format_profiles(report):
+    lines = [
+        f"source: {report['seconds']}s, {report['source_bytes'] / 1048576:.2f} MB  upload budget: {report['budget_bytes'] / 1048576:.2f} MB",
+        "profile        MB  upload MB   ratio  requests  cpu (s)  encode (s)  transcribe (s)",
+    ]
+    for r in report["profiles"]:
+        lines.append(f"  {r['profile']:<9} {r['bytes'] / 1048576:>6.2f} {r['upload_bytes'] / 1048576:>10.2f} {r['ratio']:>7.3f} {r['requests']:>9} {r['encode_cpu_seconds']:>8.2f} {r['encode_wall_seconds']:>11.2f} {r['transcribe_seconds']:>15.2f}")
+    return "\n".join(lines)
+
+def summarize(recorder, updates, wall, peak, threads_before, stubs, main):
+    by_kind = collections.defaultdict(list)
+    statuses = collections.Counter()
+    for chat_id, kind, _ in updates:
+        latency, status = recorder.done.get(chat_id, (None, "timeout"))
+        statuses[status] += 1
+        if status == "ok":
+            by_kind[kind].append(latency)
+            by_kind["all"].append(latency)
+    latency = {kind: {"count": len(v), "p50": percentile(v, 50), "p95": percentile(v, 95), "p99": percentile(v, 99), "max": max(v)} for kind, v in by_kind.items()}
+    return {
+        "updates": len(updates),
+        "statuses": dict(statuses),
+        "wall_seconds": wall,
+        "jobs_per_second": statuses["ok"] / wall if wall else 0.0,
+        "latency": latency,
+        "peak_rss_mb": peak["rss"] / 1048576,
+        "peak_children_rss_mb": peak["children_rss"] / 1048576,
+        "peak_threads": peak["threads"],
+        "threads_at_start": threads_before,
+        "peak_temp_disk_mb": peak["disk"] / 1048576,
+        "stubs": {name: dict(stub.counts) for name, stub in stubs.items()},
+        "scheduler": main.media_scheduler.stats(),
+        "errors": dict(recorder.errors),
+    }
+
+def format_report(report):
+    lines = [
+        f"updates: {report['updates']}  statuses: {report['statuses']}  complete: {report['complete']}  passed: {report['passed']}",
+        f"wall: {report['wall_seconds']:.2f}s  throughput: {report['jobs_per_second']:.2f} jobs/s",
+        "latency (s)      count     p50     p95     p99     max",
+    ]
+    for kind in sorted(report["latency"], key=lambda k: (k != "all", k)):
+        l = report["latency"][kind]
+        lines.append(f"  {kind:<12} {l['count']:>7} {l['p50']:>7.3f} {l['p95']:>7.3f} {l['p99']:>7.3f} {l['max']:>7.3f}")
+    lines += [
+        f"peak RSS: {report['peak_rss_mb']:.1f} MB (ffmpeg children peak {report['peak_children_rss_mb']:.1f} MB)",
+        f"threads: {report['threads_at_start']} at start, {report['peak_threads']} peak",
+        f"peak temp disk: {report['peak_temp_disk_mb']:.2f} MB",
+    ]
+    for text, n in report["errors"].items():
+        lines.append(f"error x{n}: {text}")
+    for name, counts in report["stubs"].items():
+        lines.append(f"{name} stub: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    return "\n".join(lines)
+
+def main_cli(argv=None):
+    p = argparse.ArgumentParser(description="Replay synthetic Telegram updates through the webhook against stub Telegram, Groq and Gemini servers.")
+    p.add_argument("--updates", type=int, default=50)
+    p.add_argument("--rate", type=float, default=10.0, help="updates per second, 0 sends them all at once")
+    p.add_argument("--mix", default="voice=6,audio=2,video=1,callback=1")
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--seconds", type=int, default=8, help="base fixture length")
+    p.add_argument("--fixtures", help="directory to generate/reuse fixtures in")
+    p.add_argument("--groq-keys", type=int, default=2)
+    p.add_argument("--transcript-chars", type=int, default=400)
+    p.add_argument("--telegram-latency", type=float, default=0.02)
+    p.add_argument("--telegram-error-rate", type=float, default=0.0)
+    p.add_argument("--groq-latency", type=float, default=0.5)
+    p.add_argument("--groq-per-mb", type=float, default=0.2, help="extra seconds per uploaded MB")
+    p.add_argument("--groq-error-rate", type=float, default=0.0)
+    p.add_argument("--groq-429-rate", type=float, default=0.0)
+    p.add_argument("--gemini-latency", type=float, default=0.8)
+    p.add_argument("--gemini-error-rate", type=float, default=0.0)
+    p.add_argument("--gemini-429-rate", type=float, default=0.0)
+    p.add_argument("--jitter", type=float, default=0.05)
+    p.add_argument("--cache", action="store_true", help="keep the transcript cache enabled")
+    p.add_argument("--timeout", type=float, default=300.0)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    p.add_argument("--json", action="store_true")
+    p.add_argument("--output", help="also write the report to this file")
+    p.add_argument("--profiles", help="compare encoder profiles instead of replaying updates, e.g. opus:24,opus:16,opus:12,mp3:48")
+    p.add_argument("--profile-seconds", type=int, default=3600, help="length of the audio the profiles are compared on")
+    args = p.parse_args(argv)
+    if args.profiles:
+        report = run_profiles(args)
+        text = json.dumps(report, indent=2) if args.json else format_profiles(report)
+    else:
+        report = run(args)
+        text = json.dumps(report, indent=2) if args.json else format_report(report)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0 if report.get("passed", report["complete"]) else 1
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,15 +1,41 @@
+import time
+PROCESS_STARTED = time.monotonic()
 import os
 import threading
 import json
 import requests
 import logging
-import time
 import tempfile
+import shutil
 import subprocess
-import glob
-from flask import Flask, request, abort
+import re
+import sqlite3
+import hashlib
+import socket
+import zlib
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+import collections
+import heapq
+import bisect
+import itertools
+import io
+import queue
+import multiprocessing
+import functools
+import fcntl
+import importlib.util
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+from flask import Flask, request, abort, Response
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 import telebot
+from telebot import apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
+HAVE_WHISPER = importlib.util.find_spec("faster_whisper") is not None
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 WEBHOOK_URL_BASE = os.environ.get("WEBHOOK_URL_BASE", "")
@@ -17,7 +43,15 @@ PORT = int(os.environ.get("PORT", "8080"))
 WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook/")
 WEBHOOK_URL = WEBHOOK_URL_BASE.rstrip('/') + WEBHOOK_PATH if WEBHOOK_URL_BASE else ""
 REQUEST_TIMEOUT = int(os.environ.get("REQUEST_TIMEOUT", "300"))
-MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", str(REQUEST_TIMEOUT)))
+HTTP_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_DEFAULT_POOL_SIZE = int(os.environ.get("HTTP_DEFAULT_POOL_SIZE", "10"))
+HTTP_POOL_SIZES = os.environ.get("HTTP_POOL_SIZES", "api.telegram.org=32,api.groq.com=16,generativelanguage.googleapis.com=8")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "2000" if TELEGRAM_API_URL else "20"))
+LOCAL_FILE_ACCESS = os.environ.get("LOCAL_FILE_ACCESS", "1" if TELEGRAM_API_URL else "0") == "1"
 MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "")
@@ -26,35 +60,1210 @@ GROQ_KEYS = os.environ.get("GROQ_KEYS", os.environ.get("GROQ_KEY", os.environ.ge
 GEMINI_KEY = os.environ.get("GEMINI_KEY", "")
 GEMINI_KEYS = os.environ.get("GEMINI_KEYS", GEMINI_KEY)
 GEMINI_MODEL = "gemini-2.5-flash"
+GROQ_API_URL = os.environ.get("GROQ_API_URL", "https://api.groq.com/openai/v1/audio/transcriptions")
+GEMINI_API_URL = os.environ.get("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
 ADMIN_CHAT_ID = 6964068910
+MEMBER_CACHE_TTL = int(os.environ.get("MEMBER_CACHE_TTL", "600"))
+MEMBER_NEGATIVE_TTL = int(os.environ.get("MEMBER_NEGATIVE_TTL", "30"))
+MEMBER_STALE_TTL = int(os.environ.get("MEMBER_STALE_TTL", str(24 * 3600)))
+MEMBER_CACHE_MAX = int(os.environ.get("MEMBER_CACHE_MAX", "200000"))
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+WEBHOOK_ALLOWED_UPDATES = ["message", "edited_message", "callback_query", "chat_member"]
+GEMINI_MEMO_SIZE = int(os.environ.get("GEMINI_MEMO_SIZE", "2000"))
+GEMINI_MEMO_TTL = int(os.environ.get("GEMINI_MEMO_TTL", str(24 * 3600)))
+GEMINI_MAX_INPUT_CHARS = int(os.environ.get("GEMINI_MAX_INPUT_CHARS", "60000"))
+GEMINI_PARALLELISM = int(os.environ.get("GEMINI_PARALLELISM", "4"))
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "4"))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", "100"))
+EXPRESS_WORKERS = int(os.environ.get("EXPRESS_WORKERS", "1"))
+EXPRESS_MAX_SECONDS = float(os.environ.get("EXPRESS_MAX_SECONDS", "90"))
+JOB_BASE_COST = float(os.environ.get("JOB_BASE_COST", "5"))
+USER_MAX_CONCURRENT = int(os.environ.get("USER_MAX_CONCURRENT", "2"))
+USER_MAX_QUEUED = int(os.environ.get("USER_MAX_QUEUED", "20"))
+USER_RATE_PER_MIN = float(os.environ.get("USER_RATE_PER_MIN", "10"))
+USER_RATE_BURST = int(os.environ.get("USER_RATE_BURST", "10"))
+IO_CONCURRENCY = int(os.environ.get("IO_CONCURRENCY", "8"))
+CPU_CONCURRENCY = int(os.environ.get("CPU_CONCURRENCY", str(os.cpu_count() or 1)))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "16"))
+CHUNK_SECONDS = int(os.environ.get("CHUNK_SECONDS", "600"))
+CHUNK_OVERLAP_SECONDS = float(os.environ.get("CHUNK_OVERLAP_SECONDS", "2"))
+TRANSCRIBE_PARALLELISM = int(os.environ.get("TRANSCRIBE_PARALLELISM", "0"))
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", "3"))
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "20"))
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", "4"))
+BATCH_SHORT_SECONDS = float(os.environ.get("BATCH_SHORT_SECONDS", "120"))
+BATCH_CONCAT_SECONDS = float(os.environ.get("BATCH_CONCAT_SECONDS", str(CHUNK_SECONDS)))
+BATCH_GAP_SECONDS = float(os.environ.get("BATCH_GAP_SECONDS", "1.5"))
+KEY_COOLDOWN_BASE = float(os.environ.get("KEY_COOLDOWN_BASE", "2"))
+KEY_COOLDOWN_MAX = float(os.environ.get("KEY_COOLDOWN_MAX", "600"))
+TRANSCRIBE_BACKEND = os.environ.get("TRANSCRIBE_BACKEND", "auto")
+LOCAL_WHISPER_MODEL = os.environ.get("LOCAL_WHISPER_MODEL", "tiny")
+LOCAL_WHISPER_DEVICE = os.environ.get("LOCAL_WHISPER_DEVICE", "cpu")
+LOCAL_WHISPER_COMPUTE_TYPE = os.environ.get("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+LOCAL_WHISPER_POOL = int(os.environ.get("LOCAL_WHISPER_POOL", str(os.cpu_count() or 1)))
+GROQ_SLOW_SECONDS = float(os.environ.get("GROQ_SLOW_SECONDS", "90"))
+GROQ_PROBE_INTERVAL = float(os.environ.get("GROQ_PROBE_INTERVAL", "60"))
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+VAD_NOISE_DB = float(os.environ.get("VAD_NOISE_DB", "-35"))
+VAD_MIN_SILENCE = float(os.environ.get("VAD_MIN_SILENCE", "0.8"))
+VAD_PAD = float(os.environ.get("VAD_PAD", "0.25"))
+VAD_MIN_SAVED_SECONDS = float(os.environ.get("VAD_MIN_SAVED_SECONDS", "3"))
+LIVE_EDIT_INTERVAL = float(os.environ.get("LIVE_EDIT_INTERVAL", "1.5"))
+STREAM_TRANSCODE = os.environ.get("STREAM_TRANSCODE", "1") == "1"
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_MB", "16")) * 1024 * 1024
+PIPE_UNSAFE_EXTS = (".mp4", ".m4a", ".m4v", ".mov", ".3gp")
+PIPE_UNSAFE_MIMES = ("video/mp4", "video/quicktime", "audio/mp4", "audio/x-m4a", "audio/m4a", "video/3gpp")
 
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, CPU_CONCURRENCY)))))
+TRANSCODE_TARGETS = {
+    "opus": (".ogg", "ogg", ["-c:a", "libopus", "-application", "voip"], "24,16,12"),
+    "mp3": (".mp3", "mp3", ["-c:a", "libmp3lame"], "48,32,24"),
+}
+TRANSCODE_TARGET = os.environ.get("TRANSCODE_TARGET", "opus").lower()
+TRANSCODE_TARGET = TRANSCODE_TARGET if TRANSCODE_TARGET in TRANSCODE_TARGETS else "opus"
+TRANSCODE_EXT, TRANSCODE_FORMAT, TRANSCODE_CODEC_BASE, _ENCODE_KBPS_DEFAULT = TRANSCODE_TARGETS[TRANSCODE_TARGET]
+ENCODE_KBPS = sorted({int(k) for k in os.environ.get("ENCODE_KBPS", _ENCODE_KBPS_DEFAULT).split(",") if k.strip()}, reverse=True)
+TRANSCODE_CODEC_ARGS = TRANSCODE_CODEC_BASE + ["-b:a", f"{ENCODE_KBPS[0]}k"]
+PROVIDER_MAX_UPLOAD_MB = float(os.environ.get("PROVIDER_MAX_UPLOAD_MB", "25"))
+UPLOAD_HEADROOM = float(os.environ.get("UPLOAD_HEADROOM", "0.9"))
+UPLOAD_BUDGET_BYTES = int(PROVIDER_MAX_UPLOAD_MB * 1024 * 1024 * UPLOAD_HEADROOM)
+SINGLE_REQUEST = os.environ.get("SINGLE_REQUEST", "1") == "1"
+PASSTHROUGH_CODECS = {"opus": ("ogg", ".ogg"), "vorbis": ("ogg", ".ogg"), "mp3": ("mp3", ".mp3"), "aac": ("mp4", ".m4a"), "flac": ("flac", ".flac")}
+PASSTHROUGH_MAX_KBPS = int(os.environ.get("PASSTHROUGH_MAX_KBPS", "64"))
+PASSTHROUGH_MAX_CHANNELS = int(os.environ.get("PASSTHROUGH_MAX_CHANNELS", "1"))
+PASSTHROUGH_MAX_RATE = int(os.environ.get("PASSTHROUGH_MAX_RATE", "48000"))
+COPY_MAX_KBPS = int(os.environ.get("COPY_MAX_KBPS", "160"))
+RANGE_MIN_BYTES = int(os.environ.get("RANGE_MIN_MB", "32")) * 1024 * 1024
+RANGE_PART_BYTES = int(os.environ.get("RANGE_PART_MB", "8")) * 1024 * 1024
+RANGE_PARALLELISM = int(os.environ.get("RANGE_PARALLELISM", "4"))
+RANGE_RETRIES = int(os.environ.get("RANGE_RETRIES", "3"))
+RANGE_RESUME_TTL = int(os.environ.get("RANGE_RESUME_TTL", str(6 * 3600)))
+PASSTHROUGH_MIMES = ("audio/ogg", "audio/opus", "audio/mpeg", "audio/mp3")
+RUN_MODE = os.environ.get("RUN_MODE", "all").lower()
+QUEUE_PATH = os.environ.get("QUEUE_PATH", os.path.join(DOWNLOADS_DIR, "updates.sqlite3"))
+QUEUE_LEASE_SECONDS = int(os.environ.get("QUEUE_LEASE_SECONDS", "120"))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_RETRY_DELAY = int(os.environ.get("QUEUE_RETRY_DELAY", "15"))
+QUEUE_DEDUP_TTL = int(os.environ.get("QUEUE_DEDUP_TTL", str(24 * 3600)))
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", "0.5"))
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "2"))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", str(MEDIA_WORKERS)))
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", str(PORT + 1)))
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", "10000"))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory" if RUN_MODE == "all" else "sqlite")
+STATE_PATH = os.environ.get("STATE_PATH", os.path.join(DOWNLOADS_DIR, "state.sqlite3"))
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", "redis://127.0.0.1:6379/0")
+STATE_MEMORY_BUDGET = int(os.environ.get("STATE_MEMORY_BUDGET_MB", "64")) * 1024 * 1024
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", "100000"))
+TRANSCRIPT_TTL = int(os.environ.get("TRANSCRIPT_TTL", str(3 * 24 * 3600)))
+PREFS_TTL = int(os.environ.get("PREFS_TTL", str(90 * 24 * 3600)))
+OUTPUT_FORMATS = {"SRT": "srt", "VTT": "vtt", "JSON": "json"}
+TIMESTAMP_HINT = "Each line of the text starts with its [m:ss] timestamp; mention the time range for every key point."
+TRANSCRIPT_CACHE_PATH = os.environ.get("TRANSCRIPT_CACHE_PATH", os.path.join(DOWNLOADS_DIR, "transcripts.sqlite3"))
+TRANSCRIPT_CACHE_TTL = int(os.environ.get("TRANSCRIPT_CACHE_TTL", str(7 * 24 * 3600)))
+TRANSCRIPT_CACHE_MAX_ENTRIES = int(os.environ.get("TRANSCRIPT_CACHE_MAX_ENTRIES", "20000"))
+
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", os.path.join(DOWNLOADS_DIR, "scratch"))
+SCRATCH_QUOTA_MB = int(os.environ.get("SCRATCH_QUOTA_MB", str(max(4096, 4 * MAX_UPLOAD_MB))))
+SCRATCH_MIN_FREE_MB = int(os.environ.get("SCRATCH_MIN_FREE_MB", "512"))
+SCRATCH_SWEEP_INTERVAL = int(os.environ.get("SCRATCH_SWEEP_INTERVAL", "600"))
+SCRATCH_ORPHAN_AGE = int(os.environ.get("SCRATCH_ORPHAN_AGE", str(6 * 3600)))
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class ResetRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+def build_http_session():
+    session = requests.Session()
+    def adapter(size):
+        retry = ResetRetry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=0, other=0, backoff_factor=0.2, raise_on_status=False)
+        return HTTPAdapter(pool_connections=4, pool_maxsize=size, max_retries=retry)
+    session.mount("http://", adapter(HTTP_DEFAULT_POOL_SIZE))
+    session.mount("https://", adapter(HTTP_DEFAULT_POOL_SIZE))
+    for item in HTTP_POOL_SIZES.split(","):
+        host, _, size = item.strip().partition("=")
+        if not host or not size.isdigit():
+            continue
+        scheme, sep, host = host.rpartition("://")
+        pool = adapter(int(size))
+        for prefix in ([scheme] if sep else ["http", "https"]):
+            session.mount(f"{prefix}://{host}/", pool)
+            session.mount(f"{prefix}://{host}:", pool)
+    return session
+
+def http_pool_stats(session):
+    stats = {}
+    for prefix, adapter in session.adapters.items():
+        pools = adapter.poolmanager.pools
+        with pools.lock:
+            conn_pools = list(pools._container.values())
+        for p in conn_pools:
+            idle = p.pool.qsize() if p.pool else 0
+            stats[f"{p.scheme}://{p.host}"] = {"mount": prefix, "maxsize": p.pool.maxsize if p.pool else 0, "idle": idle, "opened": p.num_connections, "requests": p.num_requests}
+    return stats
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART_RE.findall(value)
+    if parts:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(n) * scale[u] for n, u in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+class KeysExhausted(RuntimeError):
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
 class KeyRotator:
-    def __init__(self, keys):
+    def __init__(self, keys, name="API"):
         self.keys = [k.strip() for k in keys.split(",") if k.strip()] if isinstance(keys, str) else list(keys or [])
+        self.name = name
         self.pos = 0
         self.lock = threading.Lock()
+        self.health = {k: {"cooldown_until": 0.0, "failures": 0, "disabled": False, "remaining": None, "successes": 0, "errors": 0, "latency": None} for k in self.keys}
+        self.labels = {k: f"#{i}" for i, k in reversed(list(enumerate(self.keys)))}
+    def label(self, key):
+        return self.labels.get(key, "?")
     def get_key(self):
         with self.lock:
             if not self.keys:
                 return None
-            key = self.keys[self.pos]
-            self.pos = (self.pos + 1) % len(self.keys)
-            return key
-    def mark_success(self, key):
+            now = time.time()
+            best = None
+            for i in range(len(self.keys)):
+                key = self.keys[(self.pos + i) % len(self.keys)]
+                h = self.health[key]
+                if h["disabled"] or h["cooldown_until"] > now:
+                    continue
+                quota = float("inf") if h["remaining"] is None else h["remaining"]
+                if best is None or quota > best[1]:
+                    best = (key, quota)
+            if best is None:
+                return None
+            self.pos = (self.keys.index(best[0]) + 1) % len(self.keys)
+            return best[0]
+    def observe(self, key, headers):
+        remaining = headers.get("x-ratelimit-remaining-requests") if headers else None
+        if remaining is None:
+            return
         with self.lock:
+            h = self.health.get(key)
+            if h is None:
+                return
             try:
-                i = self.keys.index(key)
-                self.pos = (i + 1) % len(self.keys)
+                h["remaining"] = int(remaining)
             except ValueError:
+                return
+            if h["remaining"] <= 0:
+                wait = parse_retry_after(headers.get("x-ratelimit-reset-requests")) or KEY_COOLDOWN_BASE
+                h["cooldown_until"] = time.time() + min(wait, KEY_COOLDOWN_MAX)
+    def mark_success(self, key, latency=None):
+        with self.lock:
+            h = self.health.get(key)
+            if h is None:
+                return
+            h["failures"] = 0
+            h["successes"] += 1
+            if latency is not None:
+                h["latency"] = latency if h["latency"] is None else 0.8 * h["latency"] + 0.2 * latency
+    def mark_failure(self, key, exc=None):
+        resp = getattr(exc, "response", None)
+        status = getattr(resp, "status_code", None)
+        headers = getattr(resp, "headers", None) or {}
+        with self.lock:
+            h = self.health.get(key)
+            if h is None:
+                return True
+            h["errors"] += 1
+            if status in (401, 403):
+                h["disabled"] = True
+                logging.error(f"{self.name} key {self.label(key)} rejected ({status}), disabling it")
+                return True
+            if status is not None and 400 <= status < 500 and status not in (408, 409, 429):
+                return False
+            if status is None and exc is not None and not isinstance(exc, requests.RequestException):
+                return True
+            h["failures"] += 1
+            wait = parse_retry_after(headers.get("retry-after")) if status == 429 else None
+            if wait is None and status == 429:
+                wait = parse_retry_after(headers.get("x-ratelimit-reset-requests"))
+            if wait is None:
+                wait = KEY_COOLDOWN_BASE * (2 ** (h["failures"] - 1))
+            if status == 429:
+                h["remaining"] = 0
+            h["cooldown_until"] = time.time() + min(wait, KEY_COOLDOWN_MAX)
+            return True
+    def next_available_in(self):
+        with self.lock:
+            now = time.time()
+            waits = [max(0.0, h["cooldown_until"] - now) for h in self.health.values() if not h["disabled"]]
+        return min(waits) if waits else None
+    def avg_latency(self):
+        with self.lock:
+            values = [h["latency"] for h in self.health.values() if h["latency"] is not None and not h["disabled"]]
+        return sum(values) / len(values) if values else None
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {self.label(k): {"disabled": h["disabled"], "cooldown": round(max(0.0, h["cooldown_until"] - now), 1), "remaining": h["remaining"], "successes": h["successes"], "errors": h["errors"], "latency": round(h["latency"], 3) if h["latency"] is not None else None} for k, h in self.health.items()}
+
+def execute_with_rotation(rotator, action_callback):
+    last_exc = None
+    for _ in range(len(rotator.keys) or 1):
+        key = rotator.get_key()
+        if not key:
+            break
+        start = time.time()
+        key_label = rotator.label(key)
+        try:
+            result = action_callback(key)
+        except Exception as e:
+            last_exc = e
+            metrics.inc("api_key_requests_total", api=rotator.name, key=key_label, result="failure")
+            metrics.observe("api_key_latency_seconds", time.time() - start, api=rotator.name, key=key_label)
+            logging.warning(f"{rotator.name} error with key {key_label}: {e}")
+            if not rotator.mark_failure(key, e):
+                raise
+            continue
+        elapsed = time.time() - start
+        metrics.inc("api_key_requests_total", api=rotator.name, key=key_label, result="success")
+        metrics.observe("api_key_latency_seconds", elapsed, api=rotator.name, key=key_label)
+        rotator.mark_success(key, elapsed)
+        return result
+    if not rotator.keys:
+        raise RuntimeError(f"No {rotator.name} keys available")
+    metrics.inc("api_keys_exhausted_total", api=rotator.name)
+    detail = f" Last error: {last_exc}" if last_exc else ""
+    wait = rotator.next_available_in()
+    if wait is None:
+        raise KeysExhausted(f"All {rotator.name} keys are disabled.{detail}")
+    raise KeysExhausted(f"All {rotator.name} keys are cooling down, retry in {wait:.0f}s.{detail}", wait)
+
+class FairQueue:
+    def __init__(self, user_cap):
+        self.user_cap = max(1, user_cap)
+        self.queues = {}
+        self.finish = {}
+        self.running = collections.Counter()
+        self.clock = 0.0
+        self.size = 0
+        self.seq = itertools.count()
+    def _tag(self, user, cost):
+        return max(self.finish.get(user, 0.0), self.clock) + cost
+    def position(self, user, cost):
+        own = sorted(c for c, _, _ in self.queues.get(user, ()) if c <= cost)
+        tag = self._tag(user, sum(own) + cost)
+        ahead = len(own)
+        for other, q in self.queues.items():
+            if other == user:
+                continue
+            t = max(self.finish.get(other, 0.0), self.clock)
+            for c in sorted(c for c, _, _ in q):
+                t += c
+                if t >= tag:
+                    break
+                ahead += 1
+        return ahead
+    def push(self, user, cost, item):
+        heapq.heappush(self.queues.setdefault(user, []), (cost, next(self.seq), item))
+        self.size += 1
+    def pop(self, max_cost=None):
+        best = None
+        for user, q in self.queues.items():
+            if self.running[user] >= self.user_cap:
+                continue
+            cost = q[0][0]
+            if max_cost is not None and cost > max_cost:
+                continue
+            tag = self._tag(user, cost)
+            if best is None or tag < best[0]:
+                best = (tag, user)
+        if best is None:
+            return None
+        tag, user = best
+        cost, _, item = heapq.heappop(self.queues[user])
+        if not self.queues[user]:
+            del self.queues[user]
+        self.clock = tag - cost
+        self.finish[user] = tag
+        self.running[user] += 1
+        self.size -= 1
+        return user, cost, item
+    def done(self, user):
+        self.running[user] -= 1
+        if self.running[user] <= 0:
+            del self.running[user]
+            if user not in self.queues and self.finish.get(user, 0.0) <= self.clock:
+                self.finish.pop(user, None)
+        if len(self.finish) > 1000 + 4 * (len(self.queues) + len(self.running)):
+            for u in [u for u, f in self.finish.items() if f <= self.clock and u not in self.queues and u not in self.running]:
+                del self.finish[u]
+    def pending(self, user):
+        return len(self.queues.get(user, ()))
+
+def estimate_cost(media):
+    seconds = float(getattr(media, "duration", 0) or 0)
+    if not seconds:
+        seconds = (getattr(media, "file_size", 0) or 0) / 16000.0
+    return JOB_BASE_COST + seconds
+
+class JobScheduler:
+    def __init__(self, workers, queue_size, io_limit, cpu_limit, express_workers=0, express_max_cost=0.0, user_cap=1):
+        self.workers = max(1, workers)
+        self.express_workers = max(0, express_workers)
+        self.express_max_cost = express_max_cost
+        self.queue_size = queue_size
+        self.fair = FairQueue(user_cap)
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.busy = {"normal": 0, "express": 0}
+        self.started = False
+        self.limits = {"io": threading.BoundedSemaphore(max(1, io_limit)), "cpu": threading.BoundedSemaphore(max(1, cpu_limit))}
+        self.express_limits = {kind: threading.BoundedSemaphore(max(1, self.express_workers)) for kind in ("io", "cpu")}
+        self.lane = threading.local()
+    def _start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._run, args=("normal",), name=f"media-worker-{i}", daemon=True).start()
+        for i in range(self.express_workers):
+            threading.Thread(target=self._run, args=("express",), name=f"media-express-{i}", daemon=True).start()
+        self.started = True
+    def submit(self, fn, *args, user=None, cost=0.0):
+        with self.cond:
+            if self.fair.size >= self.queue_size:
+                return None
+            if not self.started:
+                self._start()
+            idle = self.workers - self.busy["normal"]
+            if cost <= self.express_max_cost:
+                idle += self.express_workers - self.busy["express"]
+            position = self.fair.position(user, cost) - idle + 1
+            self.fair.push(user, cost, (fn, args, time.monotonic()))
+            self.cond.notify_all()
+            return max(position, 0)
+    def pending(self, user):
+        with self.cond:
+            return self.fair.pending(user)
+    def stats(self):
+        with self.cond:
+            return {"queued": self.fair.size, "in_flight": self.in_flight, "users_queued": len(self.fair.queues), "users_running": len(self.fair.running), "express_busy": self.busy["express"]}
+    def in_lane(self, fn):
+        lane = getattr(self.lane, "name", "normal")
+        def run(*args):
+            self.lane.name = lane
+            return fn(*args)
+        return run
+    def _run(self, lane):
+        max_cost = self.express_max_cost if lane == "express" else None
+        self.lane.name = lane
+        while True:
+            with self.cond:
+                while True:
+                    job = self.fair.pop(max_cost)
+                    if job is not None:
+                        break
+                    self.cond.wait()
+                user, cost, (fn, args, queued_at) = job
+                self.in_flight += 1
+                self.busy[lane] += 1
+            metrics.observe("media_queue_wait_seconds", time.monotonic() - queued_at, lane=lane)
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.exception("Media job failed: %s", e)
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+                    self.busy[lane] -= 1
+                    self.fair.done(user)
+                    self.cond.notify_all()
+    @contextmanager
+    def stage(self, kind):
+        sem = (self.express_limits if getattr(self.lane, "name", None) == "express" else self.limits)[kind]
+        sem.acquire()
+        try:
+            yield
+        finally:
+            sem.release()
+
+class RateLimiter:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self.buckets = {}
+        self.lock = threading.Lock()
+    def allow(self, key, cost=1.0):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            self.buckets[key] = (tokens - cost if allowed else tokens, now)
+            if len(self.buckets) > 10000:
+                full = self.burst / self.rate
+                for k in [k for k, (_, ts) in self.buckets.items() if now - ts > full]:
+                    del self.buckets[k]
+            return allowed
+
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _metric_labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, _metric_labels(labels))] += value
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _metric_labels(labels))] = value
+    def observe(self, name, value, **labels):
+        key = (name, _metric_labels(labels))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(METRIC_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+    def collect(self, fn):
+        self.collectors.append(fn)
+        return fn
+    def render(self):
+        for fn in self.collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.warning("Metrics collector %s failed: %s", fn.__name__, e)
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{fmt(labels)} {value}")
+            seen = set()
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for bound, n in zip(METRIC_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {n}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{fmt(labels)} {total}")
+                lines.append(f"{name}_count{fmt(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+class JobTrace:
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.start = time.time()
+        self.fields = dict(fields)
+        self.stages = {}
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.stages[name] = round(self.stages.get(name, 0.0) + elapsed, 3)
+            metrics.observe("media_stage_seconds", elapsed, stage=name)
+    def finish(self, status, **fields):
+        self.fields.update(fields)
+        total = time.time() - self.start
+        metrics.observe("media_job_seconds", total, status=status)
+        metrics.inc("media_jobs_total", status=status)
+        logging.info("job_trace %s", json.dumps({"kind": self.kind, "status": status, "total": round(total, 3), "stages": self.stages, **self.fields}, default=str))
+
+class MemoCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    def _lookup(self, key):
+        item = self.items.get(key)
+        if item is not None and item[1] > time.time():
+            self.items.move_to_end(key)
+            self.hits += 1
+            return True, item[0]
+        return False, None
+    def lookup(self, key):
+        with self.lock:
+            return self._lookup(key)
+    def store(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.time() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            fut = self.inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = self.inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return fut.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            with self.lock:
+                self.inflight.pop(key, None)
+            fut.set_exception(e)
+            raise
+        self.store(key, value)
+        with self.lock:
+            self.inflight.pop(key, None)
+        fut.set_result(value)
+        return value
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "entries": len(self.items), "in_flight": len(self.inflight)}
+
+class MembershipCache:
+    def __init__(self, ttl, negative_ttl, stale_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.errors = 0
+        self.updates = 0
+    def lookup(self, user_id):
+        with self.lock:
+            item = self.entries.get(user_id)
+            if item is not None:
+                is_member, checked = item
+                if time.time() - checked < (self.ttl if is_member else self.negative_ttl):
+                    self.entries.move_to_end(user_id)
+                    self.hits += 1
+                    return is_member
+            self.misses += 1
+            return None
+    def stale(self, user_id):
+        with self.lock:
+            self.errors += 1
+            item = self.entries.get(user_id)
+            if item is not None and time.time() - item[1] < self.stale_ttl:
+                self.stale_hits += 1
+                return item[0]
+            return None
+    def put(self, user_id, is_member, from_update=False):
+        with self.lock:
+            self.entries[user_id] = (is_member, time.time())
+            self.entries.move_to_end(user_id)
+            if from_update:
+                self.updates += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / total, 4) if total else 0.0, "stale_hits": self.stale_hits, "errors": self.errors, "updates": self.updates, "entries": len(self.entries)}
+
+def is_required_channel(chat):
+    if not REQUIRED_CHANNEL:
+        return False
+    if REQUIRED_CHANNEL.lstrip("-").isdigit():
+        return str(chat.id) == REQUIRED_CHANNEL
+    return (chat.username or "").lower() == REQUIRED_CHANNEL.lstrip("@").lower()
+
+class TranscriptCache:
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transcripts_used ON transcripts (used)")
+            try:
+                self.conn.execute("ALTER TABLE transcripts ADD COLUMN segments TEXT")
+            except sqlite3.OperationalError:
+                pass
+            self.conn.commit()
+    @staticmethod
+    def make_key(kind, ident, language):
+        return f"{kind}:{ident}:{language or 'auto'}"
+    def get(self, *keys, with_segments=False):
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if not key:
+                    continue
+                row = self.conn.execute("SELECT text, created, segments FROM transcripts WHERE key = ?", (key,)).fetchone()
+                if not row:
+                    continue
+                if now - row[1] > self.ttl:
+                    self.conn.execute("DELETE FROM transcripts WHERE key = ?", (key,))
+                    self.conn.commit()
+                    continue
+                self.conn.execute("UPDATE transcripts SET used = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self.hits[key.split(":", 1)[0]] += 1
+                if with_segments:
+                    return row[0], json.loads(row[2]) if row[2] else None
+                return row[0]
+            kinds = [key.split(":", 1)[0] for key in keys if key]
+            if kinds:
+                self.misses[kinds[-1]] += 1
+            return None
+    def put(self, keys, text, segments=None):
+        now = time.time()
+        blob = json.dumps(segments, ensure_ascii=False, separators=(",", ":")) if segments else None
+        with self.lock:
+            for key in keys:
+                if key:
+                    self.conn.execute("INSERT OR REPLACE INTO transcripts (key, text, created, used, segments) VALUES (?, ?, ?, ?, ?)", (key, text, now, now, blob))
+            self.conn.execute("DELETE FROM transcripts WHERE created < ?", (now - self.ttl,))
+            count = self.conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute("DELETE FROM transcripts WHERE key IN (SELECT key FROM transcripts ORDER BY used LIMIT ?)", (count - self.max_entries,))
+            self.conn.commit()
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+            kinds = {}
+            for kind in sorted(set(self.hits) | set(self.misses)):
+                total = self.hits[kind] + self.misses[kind]
+                kinds[kind] = {"hits": self.hits[kind], "misses": self.misses[kind], "hit_ratio": round(self.hits[kind] / total, 4) if total else 0.0}
+        return {"kinds": kinds, "entries": entries}
+
+class MemoryBackend:
+    def __init__(self, budget, max_entries):
+        self.budget = budget
+        self.max_entries = max_entries
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[1] and item[1] < time.time():
+                self._drop(key)
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            if key in self.items:
+                self._drop(key)
+            self.items[key] = (value, time.time() + ttl if ttl else 0)
+            self.size += len(value)
+            while self.items and (self.size > self.budget or len(self.items) > self.max_entries):
+                self._drop(next(iter(self.items)))
+    def delete(self, key):
+        with self.lock:
+            if key in self.items:
+                self._drop(key)
+    def _drop(self, key):
+        value, _ = self.items.pop(key)
+        self.size -= len(value)
+    def stats(self):
+        with self.lock:
+            return {"backend": "memory", "entries": len(self.items), "bytes": self.size, "budget": self.budget}
+
+class SqliteBackend:
+    def __init__(self, path, budget, max_entries):
+        self.budget = budget
+        self.max_entries = max_entries
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS kv_used ON kv (used)")
+            self.conn.commit()
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] and row[1] < now:
+                self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE kv SET used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return bytes(row[0])
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO kv (key, value, expires, used) VALUES (?, ?, ?, ?)", (key, value, now + ttl if ttl else 0, now))
+            self.writes += 1
+            if self.writes % 100 == 0:
+                self._evict(now)
+            self.conn.commit()
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            self.conn.commit()
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM kv WHERE expires > 0 AND expires < ?", (now,))
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM kv").fetchone()
+        while count > self.max_entries or size > self.budget:
+            drop = max(count - self.max_entries, count // 10, 1)
+            self.conn.execute("DELETE FROM kv WHERE key IN (SELECT key FROM kv ORDER BY used LIMIT ?)", (drop,))
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM kv").fetchone()
+    def stats(self):
+        with self.lock:
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM kv").fetchone()
+        return {"backend": "sqlite", "entries": count, "bytes": size, "budget": self.budget}
+
+class RedisBackend:
+    def __init__(self, url):
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        self.reader = self.sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.reader.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise RuntimeError(f"Bad Redis reply: {line!r}")
+    def _call(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(a), a))
+        self.sock.sendall(b"".join(parts))
+        return self._read()
+    def execute(self, *args):
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._call(*args)
+                except (OSError, ConnectionError):
+                    self.sock = None
+                    if attempt:
+                        raise
+    def get(self, key):
+        return self.execute("GET", key)
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.execute("SET", key, value, "EX", int(ttl))
+        else:
+            self.execute("SET", key, value)
+    def delete(self, key):
+        self.execute("DEL", key)
+    def stats(self):
+        return {"backend": "redis", "host": f"{self.host}:{self.port}"}
+
+class StateStore:
+    def __init__(self, backend):
+        self.backend = backend
+    @staticmethod
+    def encode(value):
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if len(raw) > 256:
+            return b"z" + zlib.compress(raw, 6)
+        return b"j" + raw
+    @staticmethod
+    def decode(blob):
+        if blob[:1] == b"z":
+            return json.loads(zlib.decompress(blob[1:]).decode("utf-8"))
+        return json.loads(blob[1:].decode("utf-8"))
+    def get(self, ns, key, default=None):
+        try:
+            blob = self.backend.get(f"{ns}:{key}")
+        except Exception as e:
+            logging.warning("State read failed for %s:%s: %s", ns, key, e)
+            return default
+        return default if blob is None else self.decode(blob)
+    def set(self, ns, key, value, ttl=None):
+        try:
+            self.backend.set(f"{ns}:{key}", self.encode(value), ttl)
+        except Exception as e:
+            logging.warning("State write failed for %s:%s: %s", ns, key, e)
+    def delete(self, ns, key):
+        try:
+            self.backend.delete(f"{ns}:{key}")
+        except Exception as e:
+            logging.warning("State delete failed for %s:%s: %s", ns, key, e)
+    def stats(self):
+        return self.backend.stats()
+
+class UpdateQueue:
+    def __init__(self, path, lease_seconds, max_attempts, retry_delay, dedup_ttl):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.dedup_ttl = dedup_ttl
+        self.lock = threading.Lock()
+        self.last_purge = 0.0
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, payload BLOB, priority INTEGER NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, available REAL NOT NULL, lease_until REAL NOT NULL DEFAULT 0, owner TEXT, created REAL NOT NULL, updated REAL NOT NULL, error TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS updates_ready ON updates (status, priority, available)")
+            try:
+                self.conn.execute("ALTER TABLE updates ADD COLUMN progress TEXT")
+            except sqlite3.OperationalError:
                 pass
-    def mark_failure(self, key):
-        self.mark_success(key)
+    def enqueue(self, update_id, payload, priority=1):
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute("INSERT OR IGNORE INTO updates (update_id, payload, priority, status, available, created, updated) VALUES (?, ?, ?, 'queued', ?, ?, ?)", (update_id, payload, priority, now, now, now))
+            if now - self.last_purge > 60:
+                self.last_purge = now
+                self.conn.execute("DELETE FROM updates WHERE status IN ('done', 'dead') AND updated < ?", (now - self.dedup_ttl,))
+        return cur.rowcount == 1
+    def lease(self, owner):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("UPDATE updates SET status = 'dead', updated = ?, error = 'lease expired' WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+                row = self.conn.execute(
+                    "SELECT update_id, payload, attempts, progress FROM updates WHERE (status = 'queued' AND available <= ?) OR (status = 'leased' AND lease_until < ?) ORDER BY priority, available LIMIT 1",
+                    (now, now)).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+                self.conn.execute("UPDATE updates SET status = 'leased', attempts = attempts + 1, lease_until = ?, owner = ?, updated = ? WHERE update_id = ?", (now + self.lease_seconds, owner, now, row[0]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row[0], bytes(row[1]), row[2] + 1, json.loads(row[3]) if row[3] else {}
+    def extend(self, update_ids, owner):
+        if not update_ids:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE updates SET lease_until = ?, updated = ? WHERE update_id = ? AND owner = ? AND status = 'leased'", [(now + self.lease_seconds, now, uid, owner) for uid in update_ids])
+    def mark(self, update_id, progress):
+        with self.lock:
+            self.conn.execute("UPDATE updates SET progress = ?, updated = ? WHERE update_id = ?", (json.dumps(progress), time.time(), update_id))
+    def ack(self, update_id):
+        with self.lock:
+            self.conn.execute("UPDATE updates SET status = 'done', payload = NULL, updated = ? WHERE update_id = ?", (time.time(), update_id))
+    def nack(self, update_id, attempts, error):
+        now = time.time()
+        with self.lock:
+            if attempts >= self.max_attempts:
+                self.conn.execute("UPDATE updates SET status = 'dead', updated = ?, error = ? WHERE update_id = ?", (now, error[-1000:], update_id))
+            else:
+                self.conn.execute("UPDATE updates SET status = 'queued', available = ?, updated = ?, error = ? WHERE update_id = ?", (now + self.retry_delay * attempts, now, error[-1000:], update_id))
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM updates GROUP BY status").fetchall()
+        counts = {"queued": 0, "leased": 0, "done": 0, "dead": 0}
+        counts.update(dict(rows))
+        return counts
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _tree_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class ScratchSpace:
+    def __init__(self, root, quota, min_free, orphan_age, legacy_dir=None):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self.orphan_age = orphan_age
+        self.legacy_dir = legacy_dir
+        self.lock = threading.Lock()
+        self.tickets = {}
+        self.dirs = {}
+        self.seq = itertools.count(1)
+        self.untracked = 0
+        self.rejected = 0
+        self.swept = 0
+        os.makedirs(root, exist_ok=True)
+    def reserve(self, nbytes):
+        with self.lock:
+            committed = sum(self.tickets.values()) + self.untracked + nbytes
+            free = shutil.disk_usage(self.root).free - sum(self.tickets.values())
+            if committed > self.quota or free - nbytes < self.min_free:
+                self.rejected += 1
+                return None
+            ticket = next(self.seq)
+            self.tickets[ticket] = nbytes
+            return ticket
+    def release(self, ticket):
+        with self.lock:
+            self.tickets.pop(ticket, None)
+    def open(self, ticket=None):
+        path = tempfile.mkdtemp(prefix=f"job_{os.getpid()}_", dir=self.root)
+        with self.lock:
+            self.dirs[path] = ticket
+        return path
+    def close(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+        with self.lock:
+            ticket = self.dirs.pop(path, None)
+            self.tickets.pop(ticket, None)
+    def _orphaned(self, name, path, now):
+        age = now - os.path.getmtime(path)
+        if name.startswith("job_"):
+            try:
+                pid = int(name.split("_")[1])
+            except (IndexError, ValueError):
+                return age > self.orphan_age
+            if pid == os.getpid():
+                return path not in self.dirs and age > 60
+            return age > self.orphan_age or (age > 60 and not _pid_alive(pid))
+        if name.startswith("dl_"):
+            return age > RANGE_RESUME_TTL
+        if name.endswith(".part") or name.startswith(("tmp", "chunk_", "async_")):
+            return age > self.orphan_age
+        return False
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        untracked = 0
+        candidates = [(name, os.path.join(self.root, name)) for name in os.listdir(self.root)]
+        if self.legacy_dir and os.path.abspath(self.legacy_dir) != os.path.abspath(self.root):
+            candidates += [(name, os.path.join(self.legacy_dir, name)) for name in os.listdir(self.legacy_dir) if name.startswith(("tmp", "chunk_", "dl_", "async_"))]
+        with self.lock:
+            active = set(self.dirs)
+        for name, path in candidates:
+            if path in active:
+                continue
+            try:
+                if self._orphaned(name, path, now):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                    removed += 1
+                elif path.startswith(self.root):
+                    untracked += _tree_size(path)
+            except OSError:
+                pass
+        with self.lock:
+            self.untracked = untracked
+            self.swept += removed
+        if removed:
+            logging.info("Scratch sweeper removed %d orphaned entries", removed)
+        return removed
+    def start_sweeper(self, interval):
+        def loop():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logging.warning("Scratch sweep failed: %s", e)
+                time.sleep(interval)
+        threading.Thread(target=loop, name="scratch-sweeper", daemon=True).start()
+    def stats(self):
+        with self.lock:
+            reserved = sum(self.tickets.values())
+            jobs = len(self.dirs)
+        usage = shutil.disk_usage(self.root)
+        return {"root": self.root, "jobs": jobs, "reserved_bytes": reserved, "untracked_bytes": self.untracked, "quota_bytes": self.quota, "free_bytes": usage.free, "rejected": self.rejected, "swept": self.swept}
+
+def estimate_scratch(media):
+    size = getattr(media, "file_size", 0) or 0
+    seconds = float(getattr(media, "duration", 0) or 0) or size / 16000.0
+    return (1 if LOCAL_FILE_ACCESS else 2) * size + int(seconds * 8000) + 16 * 1024 * 1024
+
+class BatchCollector:
+    def __init__(self, window, max_files, flush):
+        self.window = window
+        self.max_files = max(1, max_files)
+        self.flush = flush
+        self.pending = {}
+        self.lock = threading.Lock()
+    def add(self, key, item):
+        ready = None
+        with self.lock:
+            entry = self.pending.setdefault(key, {"items": [], "timer": None})
+            entry["items"].append(item)
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+            if len(entry["items"]) >= self.max_files:
+                ready = self.pending.pop(key)["items"]
+            else:
+                entry["timer"] = threading.Timer(self.window, self._fire, args=(key,))
+                entry["timer"].daemon = True
+                entry["timer"].start()
+            count = len(entry["items"])
+        if ready:
+            self._flush(key, ready)
+        return count
+    def _fire(self, key):
+        with self.lock:
+            entry = self.pending.pop(key, None)
+        if entry:
+            self._flush(key, entry["items"])
+    def _flush(self, key, items):
+        try:
+            self.flush(key, items)
+        except Exception as e:
+            logging.exception("Batch flush failed for %s: %s", key, e)
+
+class RecentIds:
+    def __init__(self, size):
+        self.size = size
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def add(self, key):
+        with self.lock:
+            if key in self.ids:
+                return False
+            self.ids[key] = True
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return True
 
-groq_rotator = KeyRotator(GROQ_KEYS)
-gemini_rotator = KeyRotator(GEMINI_KEYS)
+def update_priority(data):
+    msg = data.get("message") or {}
+    media = msg.get("voice") or msg.get("audio") or msg.get("video") or msg.get("document")
+    if not media:
+        return 0
+    seconds = float(media.get("duration") or 0) or (media.get("file_size") or 0) / 16000.0
+    return 1 if seconds <= EXPRESS_MAX_SECONDS else 2
+
+def build_state_store():
+    if STATE_BACKEND == "sqlite":
+        return StateStore(SqliteBackend(STATE_PATH, STATE_MEMORY_BUDGET, STATE_MAX_ENTRIES))
+    if STATE_BACKEND == "redis":
+        return StateStore(RedisBackend(STATE_REDIS_URL))
+    return StateStore(MemoryBackend(STATE_MEMORY_BUDGET, STATE_MAX_ENTRIES))
+
+def open_audio(source):
+    if isinstance(source, str):
+        return open(source, "rb")
+    source.seek(0)
+    return source
+
+def audio_sha256(source):
+    h = hashlib.sha256()
+    f = open_audio(source)
+    try:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    finally:
+        if isinstance(source, str):
+            f.close()
+    return h.hexdigest()
+
+metrics = Metrics()
+http_session = build_http_session()
+apihelper.session = http_session
+apihelper.SESSION_TIME_TO_LIVE = None
+apihelper.CONNECT_TIMEOUT = CONNECT_TIMEOUT
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+groq_rotator = KeyRotator(GROQ_KEYS, "Groq")
+gemini_rotator = KeyRotator(GEMINI_KEYS, "Gemini")
+TRANSCRIBE_PARALLELISM = TRANSCRIBE_PARALLELISM or len(groq_rotator.keys) or 1
 
 LANGS = [
 ("🇬🇧 English","en"), ("🇸🇦 العربية","ar"), ("🇪🇸 Español","es"), ("🇫🇷 Français","fr"),
@@ -71,81 +1280,536 @@ LANGS = [
 ("🇺🇿 O'zbekcha","uz"), ("🇵🇭 Tagalog","tl"), ("🇵🇹 Português","pt")
 ]
 
-user_mode = {}
-user_transcriptions = {}
-action_usage = {}
-user_selected_lang = {}
+state = build_state_store()
+media_limiter = RateLimiter(USER_RATE_PER_MIN, USER_RATE_BURST)
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=True)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 flask_app = Flask(__name__)
+media_scheduler = JobScheduler(MEDIA_WORKERS, MEDIA_QUEUE_SIZE, IO_CONCURRENCY, CPU_CONCURRENCY, EXPRESS_WORKERS, JOB_BASE_COST + EXPRESS_MAX_SECONDS, USER_MAX_CONCURRENT)
+membership_cache = MembershipCache(MEMBER_CACHE_TTL, MEMBER_NEGATIVE_TTL, MEMBER_STALE_TTL, MEMBER_CACHE_MAX)
+gemini_memo = MemoCache(GEMINI_MEMO_SIZE, GEMINI_MEMO_TTL)
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_PATH, TRANSCRIPT_CACHE_TTL, TRANSCRIPT_CACHE_MAX_ENTRIES)
+vad_stats = {"files_trimmed": 0, "seconds_in": 0.0, "seconds_saved": 0.0}
+vad_stats_lock = threading.Lock()
+update_pool = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update")
+update_queue = UpdateQueue(QUEUE_PATH, QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_DELAY, QUEUE_DEDUP_TTL) if RUN_MODE != "all" else None
+worker_job = threading.local()
+recent_updates = RecentIds(UPDATE_DEDUP_SIZE)
+scratch = ScratchSpace(os.path.join(SCRATCH_DIR, "mediatotext"), SCRATCH_QUOTA_MB * 1024 * 1024, SCRATCH_MIN_FREE_MB * 1024 * 1024, SCRATCH_ORPHAN_AGE, DOWNLOADS_DIR)
+
+@metrics.collect
+def _collect_runtime(m):
+    sched = media_scheduler.stats()
+    m.set("media_queue_depth", sched["queued"])
+    m.set("media_jobs_in_flight", sched["in_flight"])
+    m.set("media_users_queued", sched["users_queued"])
+    m.set("update_pool_backlog", update_pool._work_queue.qsize())
+    disk = scratch.stats()
+    m.set("scratch_jobs", disk["jobs"])
+    m.set("scratch_reserved_bytes", disk["reserved_bytes"])
+    m.set("scratch_untracked_bytes", disk["untracked_bytes"])
+    m.set("scratch_free_bytes", disk["free_bytes"])
+    m.set("scratch_rejected", disk["rejected"])
+    m.set("scratch_swept", disk["swept"])
+    if update_queue is not None:
+        for status, count in update_queue.stats().items():
+            m.set("update_queue_jobs", count, status=status)
+    cache = transcript_cache.stats()
+    for kind, c in cache["kinds"].items():
+        m.set("transcript_cache_hits", c["hits"], kind=kind)
+        m.set("transcript_cache_misses", c["misses"], kind=kind)
+        m.set("transcript_cache_hit_ratio", c["hit_ratio"], kind=kind)
+    m.set("transcript_cache_entries", cache["entries"])
+    for rotator in (groq_rotator, gemini_rotator):
+        for key, h in rotator.stats().items():
+            m.set("api_key_disabled", int(h["disabled"]), api=rotator.name, key=key)
+            m.set("api_key_cooldown_seconds", h["cooldown"], api=rotator.name, key=key)
+    for name, value in membership_cache.stats().items():
+        m.set(f"membership_cache_{name}", value)
+    for name, value in gemini_memo.stats().items():
+        m.set(f"gemini_memo_{name}", value)
+    with vad_stats_lock:
+        m.set("media_vad_seconds_saved", vad_stats["seconds_saved"])
+        m.set("media_vad_files_trimmed", vad_stats["files_trimmed"])
 
 def get_user_mode(uid):
-    return user_mode.get(uid, "Split messages")
+    return state.get("mode", uid, "Split messages")
+
+def get_user_format(uid):
+    return state.get("format", uid, "Text")
+
+def get_user_lang(chat_id):
+    return state.get("lang", chat_id)
+
+def save_transcription(chat_id, message_id, data):
+    state.set("tx", f"{chat_id}:{message_id}", data, TRANSCRIPT_TTL)
+
+def get_transcription(chat_id, message_id):
+    return state.get("tx", f"{chat_id}:{message_id}")
+
+class LiveStatus:
+    def __init__(self, chat_id, message_id, reply_id, shown=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.reply_id = reply_id
+        self.text = ""
+        self.shown = shown
+        self.pending = None
+        self.last_edit = 0.0
+        self.timer = None
+        self.lock = threading.RLock()
+    def _edit(self, text, force=False):
+        if text == self.shown:
+            return
+        wait = self.last_edit + LIVE_EDIT_INTERVAL - time.time()
+        if wait > 0 and not force:
+            self.pending = text
+            if self.timer is None:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return
+        if wait > 0:
+            time.sleep(wait)
+        for _ in range(2):
+            try:
+                bot.edit_message_text(text, self.chat_id, self.message_id)
+                break
+            except telebot.apihelper.ApiTelegramException as e:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after") if e.error_code == 429 else None
+                if not retry_after:
+                    break
+                time.sleep(retry_after)
+            except Exception:
+                break
+        self.shown = text
+        self.pending = None
+        self.last_edit = time.time()
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.pending:
+                self._edit(self.pending, force=True)
+    def progress(self, label, pct=None):
+        with self.lock:
+            if self.text:
+                return
+            self._edit(f"{label} {pct:.0f}%" if pct is not None else label)
+    def append(self, piece):
+        piece = (piece or "").strip()
+        if not piece:
+            return
+        with self.lock:
+            text = f"{self.text} {piece}" if self.text else piece
+            while len(text) > MAX_MESSAGE_CHUNK:
+                cut = text.rfind(" ", 0, MAX_MESSAGE_CHUNK)
+                cut = cut if cut > MAX_MESSAGE_CHUNK // 2 else MAX_MESSAGE_CHUNK
+                self._edit(text[:cut], force=True)
+                self.message_id = bot.send_message(self.chat_id, "…", reply_to_message_id=self.reply_id).message_id
+                self.shown = "…"
+                text = text[cut:].lstrip()
+            self.text = text
+            self._edit(self.text)
+    def finish(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.text:
+                self._edit(self.text, force=True)
+            return self.message_id
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = None
 
 def execute_groq_action(action_callback):
-    last_exc = None
-    total = len(groq_rotator.keys) or 1
-    for _ in range(total + 1):
-        key = groq_rotator.get_key()
-        if not key:
-            raise RuntimeError("No Groq keys available")
-        try:
-            result = action_callback(key)
-            groq_rotator.mark_success(key)
-            return result
-        except Exception as e:
-            last_exc = e
-            logging.warning(f"Groq error with key {str(key)[:4]}: {e}")
-            groq_rotator.mark_failure(key)
-    raise RuntimeError(f"Groq failed after rotations. Last error: {last_exc}")
+    return execute_with_rotation(groq_rotator, action_callback)
+
+def _groq_segments(data):
+    return [{"start": round(float(seg.get("start", 0)), 2), "end": round(float(seg.get("end", 0)), 2), "text": (seg.get("text") or "").strip()} for seg in data.get("segments") or []]
 
-def transcribe_local_file_groq(file_path, language=None):
+def transcribe_local_file_groq(file_path, language=None, with_segments=False):
     if not groq_rotator.keys:
         raise RuntimeError("Groq key(s) not configured")
+    name = os.path.basename(file_path) if isinstance(file_path, str) else "audio" + TRANSCODE_EXT
     def perform_all_steps(key):
-        files = {"file": open(file_path, "rb")}
+        fh = open_audio(file_path)
+        files = {"file": (name, fh)}
         data = {"model": "whisper-large-v3"}
         if language:
             data["language"] = language
+        if with_segments:
+            data["response_format"] = "verbose_json"
         headers = {"authorization": f"Bearer {key}"}
-        resp = requests.post("https://api.groq.com/openai/v1/audio/transcriptions", headers=headers, files=files, data=data, timeout=REQUEST_TIMEOUT)
-        files["file"].close()
+        try:
+            with media_scheduler.stage("io"):
+                resp = http_session.post(GROQ_API_URL, headers=headers, files=files, data=data, timeout=HTTP_TIMEOUT)
+        finally:
+            if isinstance(file_path, str):
+                fh.close()
+        groq_rotator.observe(key, resp.headers)
         resp.raise_for_status()
         data = resp.json()
         text = data.get("text") or data.get("transcription") or data.get("transcript") or ""
         if not text and isinstance(data.get("results"), list) and data["results"]:
             first = data["results"][0]
             text = first.get("text") or first.get("transcript") or ""
+        if with_segments:
+            return text, _groq_segments(data)
         return text
     return execute_groq_action(perform_all_steps)
 
+class GroqBackend:
+    name = "groq"
+    def __init__(self):
+        self.last_try = 0.0
+    def available(self):
+        return bool(groq_rotator.keys)
+    def healthy(self):
+        if not self.available():
+            return False
+        if time.time() - self.last_try > GROQ_PROBE_INTERVAL:
+            return True
+        if groq_rotator.next_available_in() != 0:
+            return False
+        latency = groq_rotator.avg_latency()
+        return latency is None or latency < GROQ_SLOW_SECONDS
+    def transcribe(self, source, language=None, with_segments=False):
+        self.last_try = time.time()
+        return transcribe_local_file_groq(source, language=language, with_segments=with_segments)
+
+class LocalWhisperBackend:
+    name = "local"
+    def __init__(self, model_size, device, compute_type, pool_size):
+        self.model_size = model_size
+        self.device = device
+        self.compute_type = compute_type
+        self.pool_size = max(1, pool_size)
+        self.cpu_threads = max(1, (os.cpu_count() or 1) // self.pool_size)
+        self.models = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+    def available(self):
+        return HAVE_WHISPER
+    def _load(self):
+        from faster_whisper import WhisperModel
+        return WhisperModel(model_size_or_path=self.model_size, device=self.device, compute_type=self.compute_type, cpu_threads=self.cpu_threads)
+    def _reserve_slot(self):
+        with self.lock:
+            if self.created < self.pool_size:
+                self.created += 1
+                return True
+        return False
+    def warm(self):
+        if not self.available():
+            return
+        started = time.time()
+        while self._reserve_slot():
+            try:
+                self.models.put(self._load())
+            except Exception as e:
+                with self.lock:
+                    self.created -= 1
+                logging.error("Failed to load local Whisper model: %s", e)
+                return
+        logging.info("Local Whisper pool ready: %d x %s in %.1fs", self.pool_size, self.model_size, time.time() - started)
+        metrics.set("startup_ready_seconds", time.monotonic() - PROCESS_STARTED, component="whisper")
+    def _acquire(self):
+        try:
+            return self.models.get_nowait()
+        except queue.Empty:
+            pass
+        if self._reserve_slot():
+            try:
+                return self._load()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.models.get()
+    def transcribe(self, source, language=None, with_segments=False):
+        if not self.available():
+            raise RuntimeError("faster-whisper is not installed")
+        model = self._acquire()
+        f = open_audio(source)
+        try:
+            with media_scheduler.stage("cpu"):
+                segments, _ = model.transcribe(f, language=language)
+                segments = [{"start": round(s.start, 2), "end": round(s.end, 2), "text": s.text.strip()} for s in segments]
+                text = " ".join(s["text"] for s in segments).strip()
+                return (text, segments) if with_segments else text
+        finally:
+            if isinstance(source, str):
+                f.close()
+            self.models.put(model)
+
+groq_backend = GroqBackend()
+local_backend = LocalWhisperBackend(LOCAL_WHISPER_MODEL, LOCAL_WHISPER_DEVICE, LOCAL_WHISPER_COMPUTE_TYPE, LOCAL_WHISPER_POOL)
+
+def transcribe_audio(source, language=None, with_segments=False):
+    if TRANSCRIBE_BACKEND == "local":
+        return local_backend.transcribe(source, language=language, with_segments=with_segments)
+    if TRANSCRIBE_BACKEND == "groq" or not local_backend.available():
+        return groq_backend.transcribe(source, language=language, with_segments=with_segments)
+    if groq_backend.healthy():
+        try:
+            return groq_backend.transcribe(source, language=language, with_segments=with_segments)
+        except (KeysExhausted, requests.RequestException) as e:
+            logging.warning("Groq unavailable, falling back to local Whisper: %s", e)
+    return local_backend.transcribe(source, language=language, with_segments=with_segments)
+
+def plan_chunks(duration, limit=CHUNK_SECONDS):
+    if duration <= limit + CHUNK_OVERLAP_SECONDS:
+        return [(0.0, duration)]
+    chunks = []
+    start = 0.0
+    while start < duration:
+        length = min(limit + CHUNK_OVERLAP_SECONDS, duration - start)
+        chunks.append((start, length))
+        if start + length >= duration:
+            break
+        start += limit
+    return chunks
+
+_SILENCE_RE = re.compile(r"silence_(start|end): (-?\d+(?:\.\d+)?)")
+
+def silencedetect_cmd(input_name):
+    return ffmpeg_cmd("-nostats", "-i", input_name, "-vn", "-af", f"silencedetect=noise={VAD_NOISE_DB}dB:d={VAD_MIN_SILENCE}", "-f", "null", "-")
+
+def parse_speech_spans(stderr_text, duration):
+    silences = []
+    start = None
+    for kind, value in _SILENCE_RE.findall(stderr_text):
+        if kind == "start":
+            start = max(0.0, float(value))
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    if start is not None:
+        silences.append((start, duration))
+    spans = []
+    cursor = 0.0
+    for s_start, s_end in silences + [(duration, duration)]:
+        if s_start - cursor > 0.05:
+            span = (max(0.0, cursor - VAD_PAD), min(duration, s_start + VAD_PAD))
+            if spans and span[0] <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], span[1])
+            else:
+                spans.append(span)
+        cursor = max(cursor, s_end)
+    return spans
+
+def detect_speech_spans(source, duration):
+    cmd = silencedetect_cmd(source if isinstance(source, str) else "pipe:0")
+    data = None if isinstance(source, str) else open_audio(source).read()
+    result = subprocess.run(cmd, input=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return [(0.0, duration)]
+    return parse_speech_spans(result.stderr.decode("utf-8", "replace"), duration)
+
+def choose_spans(speech, duration):
+    speech_len = sum(e - s for s, e in speech)
+    if duration - speech_len >= VAD_MIN_SAVED_SECONDS:
+        return speech, duration - speech_len
+    return [(0.0, duration)], 0.0
+
+def plan_speech_chunks(spans, limit=CHUNK_SECONDS):
+    chunks = []
+    current = []
+    current_len = 0.0
+    for start, end in spans:
+        length = end - start
+        if current and current_len + length > limit:
+            chunks.append({"spans": current, "overlap": False})
+            current = []
+            current_len = 0.0
+        if length > limit + CHUNK_OVERLAP_SECONDS:
+            for i, (offset, piece) in enumerate(plan_chunks(length, limit)):
+                chunks.append({"spans": [(start + offset, start + offset + piece)], "overlap": i > 0})
+            continue
+        current.append((start, end))
+        current_len += length
+    if current:
+        chunks.append({"spans": current, "overlap": False})
+    return chunks
+
+def plan_audio(source, duration, limit=CHUNK_SECONDS):
+    spans = [(0.0, duration)]
+    saved = 0.0
+    if VAD_ENABLED and duration > VAD_MIN_SAVED_SECONDS:
+        with media_scheduler.stage("cpu"):
+            speech = detect_speech_spans(source, duration)
+        spans, saved = choose_spans(speech, duration)
+    return plan_speech_chunks(spans, limit), saved
+
+def audio_size(source):
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    pos = source.tell()
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(pos)
+    return size
+
+def chunk_limit(size, duration):
+    if TRANSCRIBE_BACKEND == "local" or not size or not duration:
+        return CHUNK_SECONDS
+    if SINGLE_REQUEST and size <= UPLOAD_BUDGET_BYTES:
+        return max(CHUNK_SECONDS, duration)
+    return min(CHUNK_SECONDS, UPLOAD_BUDGET_BYTES * duration / size)
+
+def render_chunk_cmd(src, chunk, out_path, codec_args=None):
+    spans = chunk["spans"]
+    if len(spans) == 1:
+        start, end = spans[0]
+        cmd = ffmpeg_cmd("-y", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", src, "-vn", "-c:a", "copy", out_path)
+    else:
+        expr = "+".join(f"between(t,{s:.3f},{e:.3f})" for s, e in spans)
+        cmd = ffmpeg_cmd("-y", "-i", src, "-vn", "-af", f"aselect='{expr}',asetpts=N/SR/TB", "-ar", "16000", "-ac", "1", *(codec_args or TRANSCODE_CODEC_ARGS), out_path)
+    return cmd
+
+def chunk_suffix(src, chunk):
+    if len(chunk["spans"]) == 1:
+        return os.path.splitext(src)[1] or TRANSCODE_EXT
+    return TRANSCODE_EXT
+
+def render_chunk(src, chunk, out_path, codec_args=None):
+    subprocess.run(render_chunk_cmd(src, chunk, out_path, codec_args), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def _norm_word(w):
+    return re.sub(r"\W+", "", w.lower())
+
+def _merge_into(merged, text, overlap=True, max_words=12, min_match=1):
+    words = (text or "").split()
+    if merged and words and overlap:
+        tail = [_norm_word(w) for w in merged[-max_words:]]
+        head = [_norm_word(w) for w in words[:max_words]]
+        for n in range(min(len(tail), len(head)), min_match - 1, -1):
+            if tail[-n:] == head[:n]:
+                words = words[n:]
+                break
+    merged.extend(words)
+    return words
+
+def merge_overlapping_texts(texts, overlaps=None):
+    merged = []
+    for i, text in enumerate(texts):
+        _merge_into(merged, text, overlaps is None or overlaps[i])
+    return " ".join(merged)
+
+def shift_time(t, spans):
+    cursor = 0.0
+    for start, end in spans:
+        if t <= cursor + end - start:
+            return start + t - cursor
+        cursor += end - start
+    return spans[-1][1]
+
+def merge_segments(parts, chunks):
+    merged = []
+    for segments, chunk in zip(parts, chunks):
+        for seg in segments or []:
+            start = shift_time(seg["start"], chunk["spans"])
+            end = max(start, shift_time(seg["end"], chunk["spans"]))
+            if chunk["overlap"] and merged and (start + end) / 2 < merged[-1]["end"]:
+                continue
+            merged.append({"start": round(start, 2), "end": round(end, 2), "text": seg["text"]})
+    return merged
+
+def transcribe_chunks(chunk_files, language=None, overlaps=None, on_text=None, chunks=None):
+    workers = max(1, min(TRANSCRIBE_PARALLELISM, len(chunk_files)))
+    merged = []
+    parts = []
+    def run(cf):
+        with metrics.timer("media_stage_seconds", stage="transcribe_chunk"):
+            return transcribe_audio(cf, language, with_segments=chunks is not None)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk") as ex:
+        futures = [ex.submit(media_scheduler.in_lane(run), cf) for cf in chunk_files]
+        for i, fut in enumerate(futures):
+            text = fut.result()
+            if chunks is not None:
+                text, segments = text
+                parts.append(segments)
+            added = _merge_into(merged, text, overlaps is None or overlaps[i])
+            if on_text:
+                on_text(i, " ".join(added))
+    if chunks is not None:
+        return " ".join(merged), merge_segments(parts, chunks)
+    return " ".join(merged)
+
+def format_timestamp(seconds, sep=","):
+    ms = int(round(max(0.0, seconds) * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    sec, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{sec:02d}{sep}{ms:03d}"
+
+def render_segments(fmt, text, segments):
+    if fmt == "JSON":
+        return json.dumps({"text": text, "segments": segments}, ensure_ascii=False, indent=1)
+    sep = "." if fmt == "VTT" else ","
+    lines = ["WEBVTT", ""] if fmt == "VTT" else []
+    for i, seg in enumerate((seg for seg in segments if seg["text"]), 1):
+        if fmt == "SRT":
+            lines.append(str(i))
+        lines.append(f"{format_timestamp(seg['start'], sep)} --> {format_timestamp(seg['end'], sep)}")
+        lines.append(seg["text"])
+        lines.append("")
+    return "\n".join(lines)
+
+def timestamped_text(segments):
+    return "\n".join(f"[{format_clock(seg['start'])}] {seg['text']}" for seg in segments if seg["text"])
+
 def gemini_api_call(endpoint, payload, key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/{endpoint}?key={key}"
+    url = f"{GEMINI_API_URL}/{endpoint}?key={key}"
     headers = {"Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+    resp = http_session.post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
+    gemini_rotator.observe(key, resp.headers)
     resp.raise_for_status()
     return resp.json()
 
 def execute_gemini_action(action_callback):
-    last_exc = None
-    total = len(gemini_rotator.keys) or 1
-    for _ in range(total + 1):
-        key = gemini_rotator.get_key()
-        if not key:
-            raise RuntimeError("No Gemini keys available")
-        try:
-            result = action_callback(key)
-            gemini_rotator.mark_success(key)
-            return result
-        except Exception as e:
-            last_exc = e
-            logging.warning(f"Gemini error with key {str(key)[:4]}: {e}")
-            gemini_rotator.mark_failure(key)
-    raise RuntimeError(f"Gemini failed after rotations. Last error: {last_exc}")
+    return execute_with_rotation(gemini_rotator, action_callback)
+
+def split_text(text, limit):
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = max(text.rfind(". ", 0, limit), text.rfind("? ", 0, limit), text.rfind("! ", 0, limit)) + 1
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        parts.append(text)
+    return parts
 
-def ask_gemini(text, instruction):
+def gemini_memo_key(text, instruction, merge_instruction=None):
+    return hashlib.sha256(f"{GEMINI_MODEL}\0{instruction}\0{merge_instruction or ''}\0{text}".encode("utf-8")).hexdigest()
+
+def ask_gemini(text, instruction, merge_instruction=None):
     if not gemini_rotator.keys:
         raise RuntimeError("GEMINI_KEY(s) not configured")
+    key = gemini_memo_key(text, instruction, merge_instruction)
+    return gemini_memo.get_or_compute(key, lambda: _ask_gemini_mapped(text, instruction, merge_instruction))
+
+def _ask_gemini_mapped(text, instruction, merge_instruction):
+    if len(text) <= GEMINI_MAX_INPUT_CHARS:
+        return _ask_gemini_once(text, instruction)
+    parts = split_text(text, GEMINI_MAX_INPUT_CHARS)
+    with ThreadPoolExecutor(max_workers=max(1, min(GEMINI_PARALLELISM, len(parts))), thread_name_prefix="gemini") as ex:
+        results = list(ex.map(lambda part: ask_gemini(part, instruction), parts))
+    if not merge_instruction:
+        return "\n\n".join(r.strip() for r in results)
+    return ask_gemini("\n\n".join(results), merge_instruction, merge_instruction)
+
+def _ask_gemini_once(text, instruction):
     def perform(key):
         payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
         data = gemini_api_call(f"models/{GEMINI_MODEL}:generateContent", payload, key)
@@ -155,12 +1819,40 @@ def ask_gemini(text, instruction):
             raise RuntimeError("Unexpected Gemini response")
     return execute_gemini_action(perform)
 
+SUMMARIZE_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("Get Summarize", callback_data="summarize_menu|")]])
+EMPTY_KEYBOARD = InlineKeyboardMarkup([])
+JOIN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{REQUIRED_CHANNEL.replace('@', '')}")]])
+MODE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
+    [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")],
+    [InlineKeyboardButton("⚡ Live messages", callback_data="mode|Live")]
+])
+FORMAT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Plain text", callback_data="format|Text")],
+    [InlineKeyboardButton("🎬 SRT subtitles", callback_data="format|SRT")],
+    [InlineKeyboardButton("🎞 VTT subtitles", callback_data="format|VTT")],
+    [InlineKeyboardButton("🧾 JSON segments", callback_data="format|JSON")]
+])
+SUMMARY_PROMPTS = {
+    "Short": "Summarize this text in the original language in 1-2 concise sentences. No extra text — return only the summary.",
+    "Detailed": "Summarize this text in the original language in a detailed paragraph preserving key points. No extra text — return only the summary.",
+    "Bulleted": "Summarize this text in the original language as a bulleted list of main points. No extra text — return only the summary.",
+}
+SUMMARY_MERGE_PROMPTS = {style: f"The text below consists of summaries of consecutive parts of one transcript. Merge them into one summary. {prompt}" for style, prompt in SUMMARY_PROMPTS.items()}
+WELCOME_TEXT = (
+    "👋 Salaam!\n"
+    "• Send me\n"
+    "• voice message\n"
+    "• audio file\n"
+    "• video\n"
+    "• to transcribe for free\n\n"
+    "Select the language spoken in your audio or video:"
+)
+
 def build_action_keyboard(text_len):
-    btns = []
-    if text_len > 1000:
-        btns.append([InlineKeyboardButton("Get Summarize", callback_data="summarize_menu|")])
-    return InlineKeyboardMarkup(btns)
+    return SUMMARIZE_KEYBOARD if text_len > 1000 else EMPTY_KEYBOARD
 
+@functools.lru_cache(maxsize=512)
 def build_lang_keyboard(origin):
     btns, row = [], []
     for i, (lbl, code) in enumerate(LANGS, 1):
@@ -172,6 +1864,7 @@ def build_lang_keyboard(origin):
         btns.append(row)
     return InlineKeyboardMarkup(btns)
 
+@functools.lru_cache(maxsize=512)
 def build_summarize_keyboard(origin):
     btns = [
         [InlineKeyboardButton("Short", callback_data=f"summopt|Short|{origin}")],
@@ -180,18 +1873,321 @@ def build_summarize_keyboard(origin):
     ]
     return InlineKeyboardMarkup(btns)
 
-def ensure_joined(message):
+def check_membership(user_id):
+    cached = membership_cache.lookup(user_id)
+    if cached is not None:
+        return cached
+    try:
+        is_member = bot.get_chat_member(REQUIRED_CHANNEL, user_id).status in MEMBER_STATUSES
+    except Exception as e:
+        stale = membership_cache.stale(user_id)
+        logging.warning("Membership check failed for %s, using %s: %s", user_id, "stale result" if stale is not None else "fail-open", e)
+        return True if stale is None else stale
+    membership_cache.put(user_id, is_member)
+    return is_member
+
+def ensure_joined(message, user=None):
     if not REQUIRED_CHANNEL:
         return True
+    if check_membership((user or message.from_user).id):
+        return True
+    if user is not None:
+        bot.send_message(message.chat.id, "First, join my channel and come back 👍", reply_markup=JOIN_KEYBOARD)
+    else:
+        bot.reply_to(message, "First, join my channel and come back 👍", reply_markup=JOIN_KEYBOARD)
+    return False
+
+_FFMPEG_TIME_RE = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+def parse_ffmpeg_time(stderr_text):
+    found = _FFMPEG_TIME_RE.findall(stderr_text or "")
+    if not found:
+        return 0.0
+    h, m, sec = found[-1]
+    return int(h) * 3600 + int(m) * 60 + float(sec)
+
+def ffmpeg_cmd(*args):
+    threads = str(FFMPEG_THREADS)
+    return ["ffmpeg", "-hide_banner", "-threads", threads, *args[:-1], "-threads", threads, args[-1]]
+
+def _probe_number(*values):
+    for value in values:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            continue
+        if number > 0:
+            return number
+    return 0.0
+
+def probe_media(file_path):
     try:
-        if bot.get_chat_member(REQUIRED_CHANNEL, message.from_user.id).status in ['member', 'administrator', 'creator']:
-            return True
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,codec_name,sample_rate,channels,bit_rate:format=format_name,duration,bit_rate,size", "-of", "json", file_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        data = json.loads(result.stdout or b"{}")
     except:
+        return None
+    streams = data.get("streams") or []
+    fmt = data.get("format") or {}
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    if audio is None:
+        return None
+    duration = _probe_number(fmt.get("duration"))
+    size = _probe_number(fmt.get("size"))
+    has_video = any(st.get("codec_type") == "video" for st in streams)
+    bit_rate = _probe_number(audio.get("bit_rate"), None if has_video else fmt.get("bit_rate"), None if has_video or not duration else size * 8 / duration)
+    return {
+        "codec": audio.get("codec_name") or "",
+        "format": fmt.get("format_name") or "",
+        "sample_rate": int(_probe_number(audio.get("sample_rate"))),
+        "channels": int(_probe_number(audio.get("channels"))),
+        "bit_rate": int(bit_rate),
+        "duration": duration,
+        "has_video": has_video,
+    }
+
+def choose_transcode(info):
+    if not info:
+        return "encode", TRANSCODE_EXT
+    container, ext = PASSTHROUGH_CODECS.get(info["codec"], (None, None))
+    if ext is None or not info["bit_rate"]:
+        return "encode", TRANSCODE_EXT
+    kbps = info["bit_rate"] / 1000.0
+    if SINGLE_REQUEST and TRANSCRIBE_BACKEND != "local" and info["duration"] * info["bit_rate"] / 8 > UPLOAD_BUDGET_BYTES >= info["duration"] * encode_profile(info["duration"]) * 125:
+        return "encode", TRANSCODE_EXT
+    if not info["has_video"] and container in info["format"].split(",") and kbps <= PASSTHROUGH_MAX_KBPS and info["channels"] <= PASSTHROUGH_MAX_CHANNELS and info["sample_rate"] <= PASSTHROUGH_MAX_RATE:
+        return "skip", ext
+    if kbps <= COPY_MAX_KBPS:
+        return "copy", ext
+    return "encode", TRANSCODE_EXT
+
+def profile_args(kbps, target=None):
+    return [*TRANSCODE_TARGETS[target or TRANSCODE_TARGET][2], "-b:a", f"{kbps}k"]
+
+def encode_profile(duration):
+    for kbps in ENCODE_KBPS:
+        if (duration or 0) * kbps * 125 <= UPLOAD_BUDGET_BYTES:
+            return kbps
+    return ENCODE_KBPS[-1]
+
+def transcode_cmd(src, out_path, mode, kbps=None):
+    if mode == "copy":
+        return ffmpeg_cmd("-y", "-i", src, "-vn", "-sn", "-dn", "-map", "0:a:0", "-c:a", "copy", out_path)
+    return ffmpeg_cmd("-y", "-i", src, "-vn", "-sn", "-dn", "-map", "0:a:0", "-ar", "16000", "-ac", "1", *(profile_args(kbps) if kbps else TRANSCODE_CODEC_ARGS), out_path)
+
+def prefer_probe(media, file_path):
+    mime = (getattr(media, "mime_type", None) or "").lower()
+    if mime.startswith("video/") or getattr(media, "width", None):
+        return True
+    if mime not in PASSTHROUGH_MIMES and not (file_path or "").lower().endswith((".oga", ".ogg", ".opus", ".mp3")):
+        return False
+    size = getattr(media, "file_size", 0) or 0
+    seconds = getattr(media, "duration", 0) or 0
+    return not seconds or size * 8 / seconds / 1000.0 <= PASSTHROUGH_MAX_KBPS
+
+def can_stream(media, file_path):
+    mime = (getattr(media, "mime_type", None) or "").lower()
+    ext = os.path.splitext(file_path or "")[1].lower()
+    return mime not in PIPE_UNSAFE_MIMES and ext not in PIPE_UNSAFE_EXTS
+
+def _content_length(resp, fallback=0):
+    try:
+        return int(resp.headers.get("content-length") or fallback or 0)
+    except ValueError:
+        return fallback or 0
+
+def telegram_file_url(file_path):
+    return f"{TELEGRAM_API_URL or 'https://api.telegram.org'}/file/bot{BOT_TOKEN}/{file_path}"
+
+def local_file_path(file_path):
+    if TELEGRAM_API_URL and file_path and os.path.isabs(file_path) and os.path.isfile(file_path):
+        return file_path
+    return None
+
+def download_file(url, path, total_bytes=0, on_progress=None):
+    with http_session.get(url, stream=True, timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        total = _content_length(r, total_bytes)
+        done = 0
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=65536):
+                if chunk:
+                    f.write(chunk)
+                    done += len(chunk)
+                    if on_progress and total:
+                        on_progress(100.0 * done / total)
+    metrics.inc("media_bytes_total", done)
+    return done
+
+def _range_total(url):
+    with http_session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            return 0
+        try:
+            return int(r.headers.get("content-range", "").rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            return 0
+
+def _load_range_state(state_path, total):
+    try:
+        with open(state_path) as f:
+            saved = json.load(f)
+        if saved.get("size") == total and saved.get("part") == RANGE_PART_BYTES:
+            return {int(k): v for k, v in saved.get("done", {}).items()}
+    except (OSError, ValueError):
         pass
-    clean = REQUIRED_CHANNEL.replace("@", "")
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{clean}")]])
-    bot.reply_to(message, "First, join my channel and come back 👍", reply_markup=kb)
-    return False
+    return None
+
+def _save_range_state(state_path, total, done):
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"size": total, "part": RANGE_PART_BYTES, "done": done}, f)
+    os.replace(tmp, state_path)
+
+def range_download(url, path, total, on_progress=None):
+    state_path = path + ".json"
+    done = _load_range_state(state_path, total) if os.path.exists(path) else None
+    if done is None:
+        done = {}
+        with open(path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, total)
+            except (AttributeError, OSError):
+                f.truncate(total)
+        _save_range_state(state_path, total, done)
+    parts = [(i * RANGE_PART_BYTES, min(total, (i + 1) * RANGE_PART_BYTES) - 1) for i in range((total + RANGE_PART_BYTES - 1) // RANGE_PART_BYTES)]
+    lock = threading.Lock()
+    progress = {"bytes": sum(done.values())}
+    resumed = progress["bytes"]
+    fd = os.open(path, os.O_WRONLY)
+    def fetch(index):
+        start, end = parts[index]
+        for attempt in range(RANGE_RETRIES + 1):
+            offset = start + done.get(index, 0)
+            if offset > end:
+                return
+            try:
+                with http_session.get(url, headers={"Range": f"bytes={offset}-{end}"}, stream=True, timeout=HTTP_TIMEOUT) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise RuntimeError(f"Range request ignored (HTTP {r.status_code})")
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        if not chunk:
+                            continue
+                        chunk = chunk[:end + 1 - offset]
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        with lock:
+                            done[index] = offset - start
+                            progress["bytes"] += len(chunk)
+                            if on_progress:
+                                on_progress(100.0 * progress["bytes"] / total)
+                if offset > end:
+                    with lock:
+                        _save_range_state(state_path, total, done)
+                    return
+            except (requests.RequestException, RuntimeError) as e:
+                if attempt >= RANGE_RETRIES:
+                    raise
+                logging.info("Range %d-%d failed at %d (%s), retrying", start, end, offset, e)
+                with lock:
+                    _save_range_state(state_path, total, done)
+                time.sleep(min(8, 2 ** attempt))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, RANGE_PARALLELISM), thread_name_prefix="range") as pool:
+            for f in [pool.submit(media_scheduler.in_lane(fetch), i) for i in range(len(parts)) if done.get(i, 0) < parts[i][1] - parts[i][0] + 1]:
+                f.result()
+    finally:
+        os.close(fd)
+        with lock:
+            if progress["bytes"] < total:
+                _save_range_state(state_path, total, done)
+    os.remove(state_path)
+    metrics.inc("media_bytes_total", progress["bytes"] - resumed)
+    metrics.inc("media_range_resumed_bytes_total", resumed)
+    return total
+
+def fetch_file(url, path, total_bytes=0, on_progress=None, resume_key=None):
+    if resume_key and total_bytes >= RANGE_MIN_BYTES:
+        total = _range_total(url)
+        if total:
+            part = os.path.join(scratch.root, f"dl_{resume_key}")
+            lock_fd = os.open(part + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logging.info("Resumable download of %s is in use by another job, downloading privately", resume_key)
+                    part = path + ".part"
+                range_download(url, part, total, on_progress)
+                os.replace(part, path)
+            finally:
+                os.close(lock_fd)
+            return total
+    return download_file(url, path, total_bytes, on_progress)
+
+def run_ffmpeg(cmd, total_seconds=0.0, on_progress=None):
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    err = []
+    buf = b""
+    for block in iter(lambda: proc.stderr.read1(4096), b""):
+        buf += block
+        *lines, buf = re.split(rb"[\r\n]", buf)
+        for line in lines:
+            text = line.decode("utf-8", "replace")
+            err.append(text)
+            if on_progress and total_seconds and "time=" in text:
+                on_progress(min(100.0, 100.0 * parse_ffmpeg_time(text) / total_seconds))
+    err.append(buf.decode("utf-8", "replace"))
+    proc.wait()
+    stderr = "\n".join(err)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr[-2000:])
+    return stderr
+
+def stream_transcode(download_url, out, total_bytes=0, on_progress=None, kbps=None):
+    proc = subprocess.Popen(ffmpeg_cmd("-i", "pipe:0", "-vn", "-ar", "16000", "-ac", "1", *(profile_args(kbps) if kbps else TRANSCODE_CODEC_ARGS), "-f", TRANSCODE_FORMAT, "pipe:1"), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = []
+    def drain_stdout():
+        for block in iter(lambda: proc.stdout.read(65536), b""):
+            out.write(block)
+    def drain_stderr():
+        err.append(proc.stderr.read().decode("utf-8", "replace"))
+    readers = [threading.Thread(target=drain_stdout, daemon=True), threading.Thread(target=drain_stderr, daemon=True)]
+    for t in readers:
+        t.start()
+    try:
+        with http_session.get(download_url, stream=True, timeout=HTTP_TIMEOUT) as r:
+            r.raise_for_status()
+            total = _content_length(r, total_bytes)
+            done = 0
+            for chunk in r.iter_content(chunk_size=65536):
+                if chunk:
+                    proc.stdin.write(chunk)
+                    done += len(chunk)
+                    if on_progress and total:
+                        on_progress(100.0 * done / total)
+            metrics.inc("media_bytes_total", done)
+    except BrokenPipeError:
+        pass
+    except Exception:
+        proc.kill()
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        proc.wait()
+        for t in readers:
+            t.join()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "ffmpeg", stderr="".join(err)[-2000:])
+    return parse_ffmpeg_time("".join(err))
 
 def get_audio_duration(file_path):
     try:
@@ -204,42 +2200,62 @@ def get_audio_duration(file_path):
     except:
         return 0.0
 
+@bot.chat_member_handler()
+def chat_member_update(update):
+    if is_required_channel(update.chat):
+        membership_cache.put(update.new_chat_member.user.id, update.new_chat_member.status in MEMBER_STATUSES, from_update=True)
+
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
     if ensure_joined(message):
-        welcome_text = (
-            "👋 Salaam!\n"
-            "• Send me\n"
-            "• voice message\n"
-            "• audio file\n"
-            "• video\n"
-            "• to transcribe for free\n\n"
-            "Select the language spoken in your audio or video:"
-        )
         kb = build_lang_keyboard("file")
-        bot.reply_to(message, welcome_text, reply_markup=kb, parse_mode="Markdown")
+        bot.reply_to(message, WELCOME_TEXT, reply_markup=kb, parse_mode="Markdown")
+
+@bot.message_handler(commands=['batch'])
+def batch_command(message):
+    if not ensure_joined(message):
+        return
+    enabled = not batch_enabled(message.from_user.id)
+    state.set("batch", message.from_user.id, enabled, PREFS_TTL)
+    if enabled:
+        bot.reply_to(message, f"📦 Batch mode is on. Files you send within {BATCH_WINDOW:g}s of each other come back as one transcript.\nSend /batch again to turn it off.")
+    else:
+        bot.reply_to(message, "Batch mode is off. Every file gets its own transcript.")
 
 @bot.message_handler(commands=['mode'])
 def choose_mode(message):
     if ensure_joined(message):
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💬 Split messages", callback_data="mode|Split messages")],
-            [InlineKeyboardButton("📄 Text File", callback_data="mode|Text File")]
-        ])
-        bot.reply_to(message, "How do I send you long transcripts?:", reply_markup=kb)
+        bot.reply_to(message, "How do I send you long transcripts?:", reply_markup=MODE_KEYBOARD)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('mode|'))
 def mode_cb(call):
-    if not ensure_joined(call.message):
+    if not ensure_joined(call.message, call.from_user):
         return
     mode = call.data.split("|")[1]
-    user_mode[call.from_user.id] = mode
+    state.set("mode", call.from_user.id, mode, PREFS_TTL)
     try:
         bot.edit_message_text(f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
         pass
     bot.answer_callback_query(call.id, f"Mode set to: {mode} ☑️")
 
+@bot.message_handler(commands=['format'])
+def choose_format(message):
+    if ensure_joined(message):
+        bot.reply_to(message, "Which format do you want your transcripts in?", reply_markup=FORMAT_KEYBOARD)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith('format|'))
+def format_cb(call):
+    if not ensure_joined(call.message, call.from_user):
+        return
+    fmt = call.data.split("|")[1]
+    state.set("format", call.from_user.id, fmt, PREFS_TTL)
+    try:
+        bot.edit_message_text(f"you choosed: {fmt}", call.message.chat.id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+    bot.answer_callback_query(call.id, f"Format set to: {fmt} ☑️")
+
 @bot.message_handler(commands=['lang'])
 def lang_command(message):
     if ensure_joined(message):
@@ -264,7 +2280,7 @@ def lang_cb(call):
         except:
             pass
     chat_id = call.message.chat.id
-    user_selected_lang[chat_id] = code
+    state.set("lang", chat_id, code, PREFS_TTL)
     bot.answer_callback_query(call.id, f"Language set: {lbl} ☑️")
     return
 
@@ -289,33 +2305,36 @@ def summopt_cb(call):
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
         pass
-    prompt = ""
-    if style == "Short":
-        prompt = "Summarize this text in the original language in 1-2 concise sentences. No extra text — return only the summary."
-    elif style == "Detailed":
-        prompt = "Summarize this text in the original language in a detailed paragraph preserving key points. No extra text — return only the summary."
-    else:
-        prompt = "Summarize this text in the original language as a bulleted list of main points. No extra text — return only the summary."
-    process_text_action(call, origin, f"Summarize ({style})", prompt)
+    process_text_action(call, origin, f"Summarize ({style})", summary_prompt(style), summary_merge_prompt(style), timed=True)
 
-def process_text_action(call, origin_msg_id, log_action, prompt_instr):
+def summary_prompt(style):
+    return SUMMARY_PROMPTS.get(style, SUMMARY_PROMPTS["Bulleted"])
+
+def summary_merge_prompt(style):
+    return SUMMARY_MERGE_PROMPTS.get(style, SUMMARY_MERGE_PROMPTS["Bulleted"])
+
+def process_text_action(call, origin_msg_id, log_action, prompt_instr, merge_instr=None, timed=False):
     chat_id = call.message.chat.id
     try:
         origin_id = int(origin_msg_id)
     except:
         origin_id = call.message.message_id
-    data = user_transcriptions.get(chat_id, {}).get(origin_id)
+    data = get_transcription(chat_id, origin_id)
     if not data:
         if call.message.reply_to_message:
-             data = user_transcriptions.get(chat_id, {}).get(call.message.reply_to_message.message_id)
+             data = get_transcription(chat_id, call.message.reply_to_message.message_id)
     if not data:
         bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
         return
     text = data["text"]
+    if timed and data.get("segments"):
+        text = timestamped_text(data["segments"])
+        prompt_instr = f"{prompt_instr} {TIMESTAMP_HINT}"
+        merge_instr = merge_instr and f"{merge_instr} {TIMESTAMP_HINT}"
     bot.answer_callback_query(call.id, "Processing...")
     bot.send_chat_action(chat_id, 'typing')
     try:
-        res = ask_gemini(text, prompt_instr)
+        res = ask_gemini(text, prompt_instr, merge_instr)
         send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
     except Exception as e:
         bot.send_message(chat_id, f"Error: {e}")
@@ -327,87 +2346,483 @@ def handle_media(message):
     media = message.voice or message.audio or message.video or message.document
     if not media:
         return
-    try:
-        bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
-    except:
-        pass
+    if not job_progress("forwarded"):
+        try:
+            bot.forward_message(ADMIN_CHAT_ID, message.chat.id, message.message_id)
+        except:
+            pass
+        mark_job("forwarded")
     if getattr(media, 'file_size', 0) > MAX_UPLOAD_SIZE:
         bot.reply_to(message, f"Just send me a file less than {MAX_UPLOAD_MB}MB 😎")
         return
-    status_msg = bot.reply_to(message, "Downloading your file...")
-    tmp_in = tempfile.NamedTemporaryFile(delete=False, dir=DOWNLOADS_DIR)
-    tmp_in_path = tmp_in.name
-    tmp_in.close()
-    tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3", dir=DOWNLOADS_DIR)
-    tmp_out_path = tmp_out.name
-    tmp_out.close()
-    created_files = [tmp_in_path, tmp_out_path]
+    group_id = getattr(message, "media_group_id", None)
+    if RUN_MODE != "worker" and (group_id or batch_enabled(message.from_user.id)):
+        batch_collector.add((message.chat.id, message.from_user.id, group_id or "burst"), (message, media))
+        return
+    enqueue_media(message, media)
+
+def enqueue_media(message, media):
+    lang = get_user_lang(message.chat.id)
+    uid = message.from_user.id
+    cached = transcript_cache.get(TranscriptCache.make_key("fid", getattr(media, "file_unique_id", None), lang), with_segments=True)
+    if cached and (cached[1] or get_user_format(uid) not in OUTPUT_FORMATS):
+        deliver_transcript(message, None, *cached)
+        return
+    if media_scheduler.pending(uid) >= USER_MAX_QUEUED:
+        bot.reply_to(message, f"You already have {USER_MAX_QUEUED} files waiting, let them finish first 🙏")
+        return
+    if not media_limiter.allow(uid):
+        metrics.inc("media_rate_limited_total")
+        bot.reply_to(message, "You're sending files too fast, please wait a minute 🙏")
+        return
+    ticket = scratch.reserve(estimate_scratch(media))
+    if ticket is None:
+        metrics.inc("media_rejected_total", reason="disk")
+        bot.reply_to(message, "I'm short on disk space right now, please send it again in a few minutes 🙏")
+        return
     try:
+        if job_progress("status_message_id"):
+            status_msg = SimpleNamespace(message_id=job_progress("status_message_id"), text=None)
+        else:
+            status_msg = bot.reply_to(message, "Downloading your file...")
+            mark_job("status_message_id", status_msg.message_id)
+        done = Future() if RUN_MODE == "worker" else None
+        if done:
+            position = media_scheduler.submit(settle_job, done, with_job(process_media), message, media, status_msg, ticket, user=uid, cost=estimate_cost(media))
+        else:
+            position = media_scheduler.submit(process_media, message, media, status_msg, ticket, user=uid, cost=estimate_cost(media))
+    except Exception:
+        scratch.release(ticket)
+        raise
+    if position is None:
+        scratch.release(ticket)
+        if done:
+            raise RuntimeError("Media queue is full")
+        bot.edit_message_text("I'm busy right now, please send it again in a few minutes 🙏", message.chat.id, status_msg.message_id)
+    elif position > 0:
+        status_msg.text = f"You are #{position} in queue ⏳"
+        try:
+            bot.edit_message_text(status_msg.text, message.chat.id, status_msg.message_id)
+        except:
+            pass
+    if done:
+        done.result()
+
+def scratch_file(workdir, suffix="", prefix="tmp"):
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=workdir)
+    os.close(fd)
+    return path
+
+def prepare_audio(media, workdir, trace, on_progress=None, allow_stream=True, prefix="tmp"):
+    with trace.stage("get_file"):
         file_info = bot.get_file(media.file_id)
-        download_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        with requests.get(download_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
-            r.raise_for_status()
-            with open(tmp_in_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-        bot.edit_message_text("Processing...", message.chat.id, status_msg.message_id)
-        subprocess.run(["ffmpeg", "-y", "-i", tmp_in_path, "-ar", "16000", "-ac", "1", "-b:a", "48k", tmp_out_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        duration = get_audio_duration(tmp_out_path)
-        lang = user_selected_lang.get(message.chat.id)
-        final_text = ""
-        if duration > 1800:
-            segment_pattern = os.path.join(DOWNLOADS_DIR, f"chunk_{os.path.basename(tmp_out_path)}_%03d.mp3")
-            subprocess.run(["ffmpeg", "-i", tmp_out_path, "-f", "segment", "-segment_time", "1800", "-c", "copy", segment_pattern], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            chunk_files = sorted(glob.glob(segment_pattern.replace("%03d", "*")))
-            for cf in chunk_files:
-                created_files.append(cf)
-                chunk_text = transcribe_local_file_groq(cf, language=lang)
-                if chunk_text:
-                    final_text += chunk_text + " "
+    download_url = telegram_file_url(file_info.file_path)
+    local_path = local_file_path(file_info.file_path)
+    file_size = getattr(media, "file_size", 0) or 0
+    progress = (lambda label: (lambda p: on_progress(label, p))) if on_progress else (lambda label: None)
+    duration = 0.0
+    audio = None
+    if allow_stream and STREAM_TRANSCODE and not local_path and file_size < RANGE_MIN_BYTES and can_stream(media, file_info.file_path) and not prefer_probe(media, file_info.file_path):
+        audio = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, dir=workdir)
+        kbps = encode_profile(float(getattr(media, "duration", 0) or 0))
+        try:
+            with media_scheduler.stage("io"), media_scheduler.stage("cpu"), trace.stage("download_transcode"):
+                duration = stream_transcode(download_url, audio, file_size, progress("Downloading"), kbps)
+            trace.fields["transcode"] = "stream"
+            trace.fields["kbps"] = kbps
+            metrics.inc("media_encode_profile_total", kbps=kbps)
+            metrics.inc("media_transcode_total", mode="stream")
+        except subprocess.CalledProcessError as e:
+            logging.info("Pipe transcode failed (%s), falling back to temp file", (e.stderr or "").strip()[-200:])
+            audio.close()
+            audio = None
+        except Exception:
+            audio.close()
+            raise
+    if audio is None:
+        if local_path:
+            tmp_in_path = local_path
         else:
-            final_text = transcribe_local_file_groq(tmp_out_path, language=lang)
+            tmp_in_path = scratch_file(workdir, prefix=prefix)
+            with media_scheduler.stage("io"), trace.stage("download"):
+                fetch_file(download_url, tmp_in_path, file_size, progress("Downloading"), getattr(media, "file_unique_id", None))
+        with trace.stage("probe"):
+            info = probe_media(tmp_in_path)
+        mode, ext = choose_transcode(info)
+        trace.fields["transcode"] = mode
+        metrics.inc("media_transcode_total", mode=mode)
+        tmp_out_path = scratch_file(workdir, ext, prefix)
+        if mode == "skip":
+            if local_path:
+                shutil.copyfile(local_path, tmp_out_path)
+            else:
+                os.replace(tmp_in_path, tmp_out_path)
+            duration = info["duration"]
+        else:
+            kbps = encode_profile((info or {}).get("duration") or float(getattr(media, "duration", 0) or 0)) if mode == "encode" else None
+            if kbps:
+                trace.fields["kbps"] = kbps
+                metrics.inc("media_encode_profile_total", kbps=kbps)
+            with media_scheduler.stage("cpu"), trace.stage("transcode"):
+                stderr = run_ffmpeg(transcode_cmd(tmp_in_path, tmp_out_path, mode, kbps), float(getattr(media, "duration", 0) or 0), progress("Converting"))
+            duration = parse_ffmpeg_time(stderr)
+            if not duration:
+                with trace.stage("probe"):
+                    duration = get_audio_duration(tmp_out_path)
+            if not local_path:
+                os.remove(tmp_in_path)
+        audio = tmp_out_path
+    duration = duration or float(getattr(media, "duration", 0) or 0)
+    metrics.inc("media_audio_seconds_total", duration)
+    return audio, duration
+
+def transcribe_prepared(audio, duration, lang, workdir, trace, on_text=None, prefix="chunk", with_segments=False):
+    limit = chunk_limit(audio_size(audio), duration)
+    with trace.stage("segment"):
+        chunks, saved = plan_audio(audio, duration, limit)
+    trace.fields["chunks"] = trace.fields.get("chunks", 0) + len(chunks)
+    if saved:
+        trace.fields["vad_saved"] = round(trace.fields.get("vad_saved", 0.0) + saved, 2)
+        logging.info("VAD trimmed %.1fs of %.1fs silence", saved, duration)
+        with vad_stats_lock:
+            vad_stats["files_trimmed"] += 1
+            vad_stats["seconds_saved"] += saved
+    with vad_stats_lock:
+        vad_stats["seconds_in"] += duration
+    if len(chunks) == 1 and chunks[0]["spans"] == [(0.0, duration)]:
+        with trace.stage("transcribe"):
+            return transcribe_audio(audio, language=lang, with_segments=with_segments)
+    if not isinstance(audio, str):
+        spooled = audio
+        audio = scratch_file(workdir, TRANSCODE_EXT)
+        spooled.seek(0)
+        with open(audio, "wb") as f:
+            for block in iter(lambda: spooled.read(1024 * 1024), b""):
+                f.write(block)
+        spooled.close()
+    chunk_files = []
+    with media_scheduler.stage("cpu"), trace.stage("segment"):
+        for i, chunk in enumerate(chunks):
+            cf = os.path.join(workdir, f"{prefix}_{i:03d}{chunk_suffix(audio, chunk)}")
+            render_chunk(audio, chunk, cf, profile_args(encode_profile(limit)))
+            chunk_files.append(cf)
+    with trace.stage("transcribe"):
+        return transcribe_chunks(chunk_files, language=lang, overlaps=[c["overlap"] for c in chunks], on_text=(lambda i, text: on_text(i, text, len(chunk_files))) if on_text else None, chunks=chunks if with_segments else None)
+
+def process_media(message, media, status_msg, ticket=None):
+    live = LiveStatus(message.chat.id, status_msg.message_id, message.id, getattr(status_msg, "text", None))
+    live_mode = get_user_mode(message.from_user.id) == "Live"
+    live.progress("Downloading your file...")
+    trace = JobTrace("media", chat_id=message.chat.id, message_id=message.id, file_size=getattr(media, "file_size", 0))
+    workdir = scratch.open(ticket)
+    audio = None
+    try:
+        audio, duration = prepare_audio(media, workdir, trace, live.progress)
+        trace.fields["audio_seconds"] = round(duration, 2)
+        live.progress("Processing...")
+        lang = get_user_lang(message.chat.id)
+        cache_keys = [TranscriptCache.make_key("fid", getattr(media, "file_unique_id", None), lang), TranscriptCache.make_key("sha256", audio_sha256(audio), lang)]
+        cached = transcript_cache.get(cache_keys[1], with_segments=True)
+        if cached and (cached[1] or get_user_format(message.from_user.id) not in OUTPUT_FORMATS):
+            transcript_cache.put(cache_keys[:1], *cached)
+            mark_job("delivered")
+            with trace.stage("send"):
+                finish_delivery(message, status_msg, live, live_mode, *cached)
+            trace.finish("cached")
+            return
+        if live_mode:
+            def on_text(i, text, n):
+                mark_job("delivered")
+                live.append(text)
+        else:
+            on_text = lambda i, text, n: live.progress("Transcribing", 100.0 * (i + 1) / n)
+        final_text, segments = transcribe_prepared(audio, duration, lang, workdir, trace, on_text, with_segments=True)
         if not final_text:
             raise ValueError("Empty transcription")
+        trace.fields["segments"] = len(segments or [])
+        transcript_cache.put(cache_keys, final_text, segments)
+        mark_job("delivered")
+        with trace.stage("send"):
+            finish_delivery(message, status_msg, live, live_mode, final_text, segments)
+        trace.finish("ok", chars=len(final_text))
+    except Exception as e:
+        logging.exception("Media job failed for chat %s: %s", message.chat.id, e)
+        trace.finish("error", error=f"{type(e).__name__}: {e}")
+        live.cancel()
+        retry = RUN_MODE == "worker" and is_transient(e) and not job_progress("delivered")
+        if retry and not getattr(worker_job, "final", True):
+            raise
+        bot.send_message(message.chat.id, "😓")
+        if retry:
+            raise
+    finally:
+        if audio is not None and not isinstance(audio, str):
+            audio.close()
+        scratch.close(workdir)
+
+def concat_cmd(inputs, out_path, gap):
+    args = []
+    for path in inputs:
+        args += ["-i", path]
+    filters = [f"[{i}:a]aresample=16000,aformat=sample_fmts=s16:channel_layouts=mono,apad=pad_dur={gap}[a{i}]" for i in range(len(inputs))]
+    graph = ";".join(filters) + ";" + "".join(f"[a{i}]" for i in range(len(inputs))) + f"concat=n={len(inputs)}:v=0:a=1[out]"
+    return ffmpeg_cmd("-y", *args, "-filter_complex", graph, "-map", "[out]", "-ac", "1", "-ar", "16000", *TRANSCODE_CODEC_ARGS, out_path)
+
+def pack_clips(clips, limit, gap):
+    groups = []
+    current = []
+    total = 0.0
+    for index, duration in clips:
+        if current and total + duration > limit:
+            groups.append(current)
+            current = []
+            total = 0.0
+        current.append(index)
+        total += duration + gap
+    if current:
+        groups.append(current)
+    return groups
+
+def clip_offsets(durations, gap):
+    offsets = []
+    cursor = 0.0
+    for d in durations:
+        offsets.append(cursor)
+        cursor += d + gap
+    return offsets
+
+def split_segments(segments, offsets):
+    texts = [[] for _ in offsets]
+    for seg in segments:
+        mid = (seg["start"] + seg["end"]) / 2.0
+        i = max(0, bisect.bisect_right(offsets, mid) - 1)
+        if seg["text"]:
+            texts[i].append(seg["text"])
+    return [" ".join(t).strip() for t in texts]
+
+def transcribe_group(paths, durations, lang, workdir, trace):
+    out_path = scratch_file(workdir, TRANSCODE_EXT, "concat_")
+    with media_scheduler.stage("cpu"), trace.stage("concat"):
+        run_ffmpeg(concat_cmd(paths, out_path, BATCH_GAP_SECONDS))
+    with trace.stage("transcribe"):
+        text, segments = transcribe_audio(out_path, language=lang, with_segments=True)
+    if not segments:
+        return None
+    metrics.inc("batch_requests_saved_total", len(paths) - 1)
+    return split_segments(segments, clip_offsets(durations, BATCH_GAP_SECONDS))
+
+def media_label(message, media):
+    if message.voice:
+        return "Voice note"
+    if message.video:
+        return "Video"
+    name = getattr(media, "file_name", None) or getattr(media, "title", None)
+    return name or ("Audio" if message.audio else "File")
+
+def format_clock(seconds):
+    seconds = int(round(seconds or 0))
+    h, rem = divmod(seconds, 3600)
+    m, sec = divmod(rem, 60)
+    return f"{h}:{m:02d}:{sec:02d}" if h else f"{m}:{sec:02d}"
+
+def batch_enabled(uid):
+    return bool(state.get("batch", uid, False))
+
+def submit_batch(key, items):
+    if len(items) == 1:
+        return enqueue_media(*items[0])
+    message = items[0][0]
+    uid = message.from_user.id
+    if media_scheduler.pending(uid) >= USER_MAX_QUEUED:
+        bot.reply_to(message, f"You already have {USER_MAX_QUEUED} files waiting, let them finish first 🙏")
+        return
+    if not media_limiter.allow(uid):
+        metrics.inc("media_rate_limited_total")
+        bot.reply_to(message, "You're sending files too fast, please wait a minute 🙏")
+        return
+    ticket = scratch.reserve(sum(estimate_scratch(media) for _, media in items))
+    if ticket is None:
+        metrics.inc("media_rejected_total", reason="disk")
+        bot.reply_to(message, "I'm short on disk space right now, please send them again in a few minutes 🙏")
+        return
+    try:
+        status_msg = bot.reply_to(message, f"📦 Got {len(items)} files, downloading...")
+        position = media_scheduler.submit(process_batch, items, status_msg, ticket, user=uid, cost=sum(estimate_cost(media) for _, media in items))
+    except Exception:
+        scratch.release(ticket)
+        raise
+    if position is None:
+        scratch.release(ticket)
+        bot.edit_message_text("I'm busy right now, please send them again in a few minutes 🙏", message.chat.id, status_msg.message_id)
+    elif position > 0:
+        status_msg.text = f"You are #{position} in queue ⏳"
+        try:
+            bot.edit_message_text(status_msg.text, message.chat.id, status_msg.message_id)
+        except:
+            pass
+
+batch_collector = BatchCollector(BATCH_WINDOW, BATCH_MAX_FILES, submit_batch)
+
+def process_batch(items, status_msg, ticket=None):
+    first = items[0][0]
+    chat_id = first.chat.id
+    live = LiveStatus(chat_id, status_msg.message_id, first.id, getattr(status_msg, "text", None))
+    trace = JobTrace("batch", chat_id=chat_id, message_id=first.id, files=len(items))
+    workdir = scratch.open(ticket)
+    lang = get_user_lang(chat_id)
+    results = [None] * len(items)
+    done = [0]
+    lock = threading.Lock()
+    def tick(label):
+        with lock:
+            done[0] += 1
+            live.progress(label, 100.0 * done[0] / len(items))
+    def prepare(i):
+        message, media = items[i]
+        fid_key = TranscriptCache.make_key("fid", getattr(media, "file_unique_id", None), lang)
+        try:
+            cached = transcript_cache.get(fid_key)
+            if cached:
+                results[i] = cached
+                return None
+            audio, duration = prepare_audio(media, workdir, trace, allow_stream=False, prefix=f"f{i:02d}_")
+            keys = [fid_key, TranscriptCache.make_key("sha256", audio_sha256(audio), lang)]
+            cached = transcript_cache.get(keys[1])
+            if cached:
+                transcript_cache.put(keys[:1], cached)
+                results[i] = cached
+                return None
+            return {"audio": audio, "duration": duration, "keys": keys}
+        except Exception as e:
+            logging.exception("Batch file %d failed for chat %s: %s", i, chat_id, e)
+            results[i] = e
+            return None
+        finally:
+            tick("Downloading")
+    def transcribe_one(i, job):
+        try:
+            text = transcribe_prepared(job["audio"], job["duration"], lang, workdir, trace, prefix=f"chunk{i:02d}")
+            results[i] = text
+            if text:
+                transcript_cache.put(job["keys"], text)
+        except Exception as e:
+            logging.exception("Batch file %d failed for chat %s: %s", i, chat_id, e)
+            results[i] = e
+    def transcribe_pack(group):
+        texts = None
+        try:
+            texts = transcribe_group([jobs[i]["audio"] for i in group], [jobs[i]["duration"] for i in group], lang, workdir, trace)
+        except Exception as e:
+            logging.warning("Concatenated batch transcription failed, retrying files one by one: %s", e)
+        if texts is None:
+            for i in group:
+                transcribe_one(i, jobs[i])
+            return
+        for i, text in zip(group, texts):
+            results[i] = text
+            if text:
+                transcript_cache.put(jobs[i]["keys"], text)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, BATCH_PARALLELISM), thread_name_prefix="batch") as ex:
+            jobs = dict(enumerate(ex.map(media_scheduler.in_lane(prepare), range(len(items)))))
+        jobs = {i: job for i, job in jobs.items() if job}
+        trace.fields["audio_seconds"] = round(sum(job["duration"] for job in jobs.values()), 2)
+        live.progress("Transcribing...")
+        short = [(i, job["duration"]) for i, job in jobs.items() if job["duration"] <= BATCH_SHORT_SECONDS]
+        groups = [g for g in pack_clips(short, BATCH_CONCAT_SECONDS, BATCH_GAP_SECONDS) if len(g) > 1]
+        grouped = {i for g in groups for i in g}
+        trace.fields["groups"] = len(groups)
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_PARALLELISM, TRANSCRIBE_PARALLELISM)), thread_name_prefix="batch") as ex:
+            futures = [ex.submit(media_scheduler.in_lane(transcribe_pack), g) for g in groups]
+            futures += [ex.submit(media_scheduler.in_lane(transcribe_one), i, job) for i, job in jobs.items() if i not in grouped]
+            for f in futures:
+                f.result()
+        parts = []
+        for i, ((message, media), result) in enumerate(zip(items, results)):
+            seconds = jobs[i]["duration"] if i in jobs else getattr(media, "duration", 0)
+            header = f"📄 {i + 1}. {media_label(message, media)}" + (f" ({format_clock(seconds)})" if seconds else "")
+            if isinstance(result, Exception) or result is None:
+                body = "⚠️ Could not transcribe this file."
+            else:
+                body = result or "(no speech)"
+            parts.append(f"{header}\n{body}")
+        failed = sum(1 for r in results if isinstance(r, Exception) or r is None)
+        if failed == len(items):
+            raise RuntimeError("Every file in the batch failed")
+        combined = "\n\n".join(parts)
+        live.finish()
+        with trace.stage("send"):
+            deliver_transcript(first, status_msg, combined)
+        trace.finish("ok", chars=len(combined), failed=failed)
+    except Exception as e:
+        logging.exception("Batch job failed for chat %s: %s", chat_id, e)
+        trace.finish("error", error=f"{type(e).__name__}: {e}")
+        live.cancel()
+        bot.send_message(chat_id, "😓")
+    finally:
+        scratch.close(workdir)
+
+def transcript_record(message, final_text, segments=None):
+    data = {"text": final_text, "origin": message.id}
+    if segments:
+        data["segments"] = segments
+    return data
+
+def finish_delivery(message, status_msg, live, live_mode, final_text, segments=None):
+    if not live_mode:
+        live.finish()
+        return deliver_transcript(message, status_msg, final_text, segments)
+    if not live.text:
+        live.append(final_text)
+    last_id = live.finish()
+    save_transcription(message.chat.id, last_id, transcript_record(message, final_text, segments))
+    try:
+        bot.edit_message_reply_markup(message.chat.id, last_id, reply_markup=build_action_keyboard(len(final_text)))
+    except:
+        pass
+    send_segments(message.chat.id, final_text, segments, message.id, message.from_user.id)
+    return last_id
+
+def deliver_transcript(message, status_msg, final_text, segments=None):
+    if status_msg:
         bot.edit_message_text("Completed 😍", message.chat.id, status_msg.message_id)
         time.sleep(1)
         try:
             bot.delete_message(message.chat.id, status_msg.message_id)
         except:
             pass
-        sent = send_long_text(message.chat.id, final_text, message.id, message.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = {"text": final_text, "origin": message.id}
-            if len(final_text) > 0:
-                try:
-                    bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(final_text)))
-                except:
-                    pass
-    except Exception:
-        bot.send_message(message.chat.id, "😓")
-    finally:
-        for fpath in created_files:
+    sent = send_long_text(message.chat.id, final_text, message.id, message.from_user.id, segments=segments)
+    if sent:
+        save_transcription(message.chat.id, sent.message_id, transcript_record(message, final_text, segments))
+        if len(final_text) > 0:
             try:
-                if os.path.exists(fpath):
-                    os.remove(fpath)
+                bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(final_text)))
             except:
                 pass
+    return sent
+
+def send_segments(chat_id, text, segments, reply_id, uid, action="Transcript"):
+    if not segments:
+        return None
+    fmt = get_user_format(uid)
+    if fmt not in OUTPUT_FORMATS:
+        return None
+    doc = render_segments(fmt, text, segments).encode("utf-8")
+    return bot.send_document(chat_id, io.BytesIO(doc), visible_file_name=f"{action}.{OUTPUT_FORMATS[fmt]}", caption=f"{fmt} with timestamps 🕒", reply_to_message_id=reply_id)
 
-def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
+def send_long_text(chat_id, text, reply_id, uid, action="Transcript", segments=None):
+    sent = send_segments(chat_id, text, segments, reply_id, uid, action)
+    if sent:
+        return sent
     mode = get_user_mode(uid)
     if len(text) > MAX_MESSAGE_CHUNK:
-        if mode == "Split messages":
+        if mode in ("Split messages", "Live"):
             sent = None
             for i in range(0, len(text), MAX_MESSAGE_CHUNK):
                 sent = bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
             return sent
         else:
-            fname = os.path.join(DOWNLOADS_DIR, f"{action}.txt")
-            with open(fname, "w", encoding="utf-8") as f:
-                f.write(text)
-            sent = bot.send_document(chat_id, open(fname, 'rb'), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
-            os.remove(fname)
-            return sent
+            return bot.send_document(chat_id, io.BytesIO(text.encode("utf-8")), visible_file_name=f"{action}.txt", caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
     sent = bot.send_message(chat_id, text, reply_to_message_id=reply_id)
     return sent
 
@@ -418,23 +2833,180 @@ def _process_webhook_update(raw):
     except Exception as e:
         logging.exception("Error processing update: %s", e)
 
+def is_transient(e):
+    if isinstance(e, (KeysExhausted, requests.ConnectionError, requests.Timeout, sqlite3.OperationalError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, apihelper.ApiTelegramException):
+        return e.error_code == 429 or e.error_code >= 500
+    if isinstance(e, (requests.HTTPError, apihelper.ApiHTTPException)):
+        resp = e.response if isinstance(e, requests.HTTPError) else e.result
+        status = getattr(resp, "status_code", None)
+        return status is not None and (status == 429 or status >= 500)
+    return False
+
+def job_progress(step):
+    return (getattr(worker_job, "progress", None) or {}).get(step)
+
+def mark_job(step, value=True):
+    progress = getattr(worker_job, "progress", None)
+    if progress is None or progress.get(step) == value:
+        return
+    progress[step] = value
+    update_queue.mark(worker_job.update_id, progress)
+
+def with_job(fn):
+    state = dict(vars(worker_job))
+    def run(*args):
+        vars(worker_job).update(state)
+        try:
+            return fn(*args)
+        finally:
+            worker_job.progress = None
+    return run
+
+def settle_job(done, fn, *args):
+    try:
+        done.set_result(fn(*args))
+    except BaseException as e:
+        done.set_exception(e)
+
+def worker_loop(owner, inflight, lock):
+    while True:
+        try:
+            job = update_queue.lease(owner)
+        except sqlite3.OperationalError as e:
+            logging.warning("Queue lease failed: %s", e)
+            job = None
+        if job is None:
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        update_id, payload, attempts, progress = job
+        with lock:
+            inflight.add(update_id)
+        worker_job.update_id = update_id
+        worker_job.progress = progress
+        worker_job.final = attempts >= QUEUE_MAX_ATTEMPTS
+        started = time.time()
+        try:
+            bot.process_new_updates([Update.de_json(payload.decode("utf-8"))])
+            update_queue.ack(update_id)
+            metrics.inc("queue_jobs_total", result="ok")
+        except Exception as e:
+            logging.exception("Update %s failed (attempt %d): %s", update_id, attempts, e)
+            update_queue.nack(update_id, attempts, f"{type(e).__name__}: {e}".replace(BOT_TOKEN, "<token>"))
+            metrics.inc("queue_jobs_total", result="retry" if attempts < QUEUE_MAX_ATTEMPTS else "dead")
+        finally:
+            worker_job.progress = None
+            with lock:
+                inflight.discard(update_id)
+            metrics.observe("queue_job_seconds", time.time() - started)
+
+def run_worker(index=0):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    if WORKER_METRICS_PORT:
+        metrics_app = Flask(f"worker-{index}")
+        metrics_app.add_url_rule("/metrics", view_func=metrics_route)
+        threading.Thread(target=metrics_app.run, kwargs={"host": "0.0.0.0", "port": WORKER_METRICS_PORT + index}, name="worker-metrics", daemon=True).start()
+    if TRANSCRIBE_BACKEND != "groq" and local_backend.available():
+        threading.Thread(target=local_backend.warm, name="whisper-warmup", daemon=True).start()
+    scratch.start_sweeper(SCRATCH_SWEEP_INTERVAL)
+    inflight = set()
+    lock = threading.Lock()
+    for i in range(max(1, WORKER_THREADS)):
+        threading.Thread(target=worker_loop, args=(owner, inflight, lock), name=f"queue-worker-{i}", daemon=True).start()
+    logging.info("Worker %s consuming %s with %d threads", owner, QUEUE_PATH, WORKER_THREADS)
+    metrics.set("startup_ready_seconds", time.monotonic() - PROCESS_STARTED, component="worker")
+    while True:
+        time.sleep(max(1.0, QUEUE_LEASE_SECONDS / 3.0))
+        with lock:
+            ids = list(inflight)
+        try:
+            update_queue.extend(ids, owner)
+        except sqlite3.OperationalError as e:
+            logging.warning("Lease heartbeat failed: %s", e)
+
+def run_workers(count):
+    if count <= 1:
+        return run_worker()
+    ctx = multiprocessing.get_context("spawn")
+    procs = {}
+    while True:
+        for i in range(count):
+            proc = procs.get(i)
+            if proc is None or not proc.is_alive():
+                if proc is not None:
+                    logging.warning("Worker process %d exited with %s, restarting", i, proc.exitcode)
+                proc = ctx.Process(target=run_worker, args=(i,), name=f"worker-{i}", daemon=True)
+                proc.start()
+                procs[i] = proc
+        time.sleep(2)
+
+def webhook_matches(info):
+    return info is not None and info.url == WEBHOOK_URL and sorted(info.allowed_updates or []) == sorted(WEBHOOK_ALLOWED_UPDATES)
+
+def register_webhook():
+    delay = 1.0
+    while True:
+        try:
+            if webhook_matches(bot.get_webhook_info()):
+                logging.info("Webhook already registered at %s", WEBHOOK_URL)
+                metrics.inc("startup_webhook_total", action="kept")
+            else:
+                bot.set_webhook(url=WEBHOOK_URL, allowed_updates=WEBHOOK_ALLOWED_UPDATES)
+                metrics.inc("startup_webhook_total", action="set")
+            break
+        except Exception as e:
+            logging.exception("Webhook registration failed, retrying in %.0fs: %s", delay, e)
+            metrics.inc("startup_webhook_total", action="error")
+            time.sleep(delay)
+            delay = min(delay * 2, 60.0)
+    metrics.set("startup_ready_seconds", time.monotonic() - PROCESS_STARTED, component="webhook")
+    logging.info("Ready %.2fs after process start", time.monotonic() - PROCESS_STARTED)
+
 @flask_app.route("/", methods=["GET"])
 def index():
     return "Bot Running", 200
 
+@flask_app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@flask_app.route("/stats", methods=["GET"])
+def stats():
+    return {"state": state.stats(), "transcript_cache": transcript_cache.stats(), "gemini_memo": gemini_memo.stats(), "membership_cache": membership_cache.stats(), "groq_keys": groq_rotator.stats(), "gemini_keys": gemini_rotator.stats(), "http_pools": http_pool_stats(http_session), "vad": vad_stats, "scheduler": media_scheduler.stats(), "queue": update_queue.stats() if update_queue else None, "scratch": scratch.stats()}, 200
+
 @flask_app.route(WEBHOOK_PATH, methods=['POST'])
 def webhook():
     if request.headers.get('content-type', '').startswith('application/json'):
         data = request.get_data()
-        threading.Thread(target=_process_webhook_update, args=(data,), daemon=True).start()
+        try:
+            parsed = json.loads(data)
+        except ValueError:
+            abort(400)
+        update_id = parsed.get("update_id") if isinstance(parsed, dict) else None
+        if not isinstance(update_id, int) or isinstance(update_id, bool):
+            abort(400)
+        if update_queue is not None:
+            if not update_queue.enqueue(update_id, data, update_priority(parsed)):
+                metrics.inc("webhook_duplicates_total")
+            return '', 200
+        if not recent_updates.add(update_id):
+            metrics.inc("webhook_duplicates_total")
+            return '', 200
+        update_pool.submit(_process_webhook_update, data)
         return '', 200
     abort(403)
 
 if __name__ == "__main__":
+    if RUN_MODE == "worker":
+        run_workers(WORKER_PROCESSES)
+        raise SystemExit(0)
+    if RUN_MODE == "all":
+        scratch.start_sweeper(SCRATCH_SWEEP_INTERVAL)
+    if RUN_MODE == "all" and TRANSCRIBE_BACKEND != "groq" and local_backend.available():
+        threading.Thread(target=local_backend.warm, name="whisper-warmup", daemon=True).start()
     if WEBHOOK_URL:
-        bot.remove_webhook()
-        time.sleep(0.5)
-        bot.set_webhook(url=WEBHOOK_URL)
+        threading.Thread(target=register_webhook, name="webhook-register", daemon=True).start()
         flask_app.run(host="0.0.0.0", port=PORT)
     else:
         print("Webhook URL not set, exiting.")